@@ -1,32 +1,80 @@
-from fastapi import FastAPI, File, UploadFile, WebSocket, Form
+from fastapi import FastAPI, File, UploadFile, WebSocket, Form, Header, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.websockets import WebSocketState
+from contextlib import asynccontextmanager
 from typing import Optional
-from PIL import Image
 import json
-import base64
-import io
+import asyncio
+import binascii
+import hmac
+import logging
 import os
-from firebase_admin import firestore
 import firebase_admin
 from firebase_admin import credentials
-from io import BytesIO
 
 from generate_image import *
+from comfyui_pool import start_comfyui_pool, close_comfyui_pool
+from firebase_io import shutdown_firebase_io
+from jobs import JobManager, JobStore
+from workflow_templates import workflow_registry
+from result_cache import result_cache
+from persona_store import persona_store
+from warmup import ComfyUIWarmup
+from image_preprocess import start_preprocess, shutdown_preprocess
+from metrics import Gauge, registry, span
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
 
-from image_prompt import prompt
+from image_prompt import build_persona_prompts, validate_prompts
 load_dotenv()
 
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger("main")
+
+# /comfyui/pool/drain 같은 관리용 API 에 보낼 토큰 (Authorization: Bearer <토큰>).
+# 비워 두면 관리용 API 는 꺼지고 서버를 빼는 것은 COMFYUI_DRAIN 으로만 한다.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
 cred = credentials.Certificate("mirrorgram-20713-firebase-adminsdk-u9pdx-c3e12134b4.json")
 firebase_admin.initialize_app(cred, {
     'storageBucket': 'mirrorgram-20713.appspot.com'
 })
 
 
-db = firestore.client()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 워크플로 JSON은 시작할 때 한 번 읽고 검증한다 (파일이 바뀌면 다음 요청 때 다시 읽는다)
+    workflow_registry.load_all()
+    # 감정 목록이 가리키는 프롬프트가 모두 있는지 확인한다
+    validate_prompts()
+    # 입력 이미지 전처리 프로세스는 다른 스레드와 소켓이 생기기 전에 미리 띄운다
+    await start_preprocess()
+    # COMFYUI_URLS 의 서버마다 커넥션 풀을 가진 클라이언트 하나씩을 두고 부하에 따라 나눠 보낸다
+    app.state.comfyui = await start_comfyui_pool()
+    # 서버마다 워크플로를 적은 step 으로 한 번씩 실행해서 모델을 미리 올린다 (끝날 때까지 /readiness 는 503)
+    app.state.warmup = ComfyUIWarmup(app.state.comfyui)
+    await app.state.warmup.start()
+    # 이전 프로세스가 ComfyUI input 폴더에 남긴 업로드 파일 정리 (COMFYUI_INPUT_DIR 설정 시)
+    removed = upload_cache.cleanup_input_dir()
+    if removed:
+        logger.info("ComfyUI input 폴더에서 오래된 업로드 %d개 삭제", removed)
+    # 페르소나 생성 작업은 SQLite에 저장하고 정해진 수의 워커가 처리한다
+    app.state.jobs = JobManager(JobStore(), run_persona_job)
+    await app.state.jobs.start()
+    yield
+    await app.state.jobs.stop()
+    await app.state.warmup.stop()
+    await close_comfyui_pool()
+    # 모아 둔 Firestore 쓰기를 스레드 풀을 닫기 전에 보낸다
+    await persona_store.close()
+    shutdown_firebase_io()
+    shutdown_preprocess()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
 
@@ -38,59 +86,211 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/generate-persona-images")
-async def generate_persona_images(
-    image: Optional[UploadFile] = File(None),
-    customPersona: str = Form(...),
-    uid: str = Form(...)
-):
-    user_ref = db.collection('users').document(uid).get().to_dict()
+async def generate_persona_for_user(uid: str, customPersona: str, contents: Optional[bytes] = None, on_result=None):
+    # users/{uid} 는 여기서 한 번만 읽는다 (짧은 TTL 캐시, 같은 사용자의 동시 읽기는 하나로 합친다)
+    user_ref = await persona_store.get_user(uid)
+    if user_ref is None:
+        raise HTTPException(status_code=404, detail=f"User not found: {uid}")
     
     persona_data = json.loads(customPersona) if isinstance(customPersona, str) else customPersona
 
-    # prompt['custom'] = persona_data['personality']
-    prompt['custom'] = f"""
+    # 공유 프롬프트를 고치지 않고 이 요청만의 custom / clone 프롬프트를 만든다 (동시 요청끼리 덮어쓰지 않게)
+    prompts = build_persona_prompts(persona_data)
 
-    make character based on
+    final_image = None
+    
+    if contents:
+        # 업로드된 이미지 바이트는 디코딩하지 않고 그대로 넘겨서 전처리 프로세스에서 연다
+        final_image = contents
+    else:
+        # 기본 이미지는 경로로 넘긴다 (전처리 결과를 경로별로 기억해 두고 다시 쓴다)
+        gender = user_ref['profile']['gender']
+        final_image = 'assets/images/male.jpg' if gender == 'male' else 'assets/images/female.webp'
+    
+    # 이제 동일한 함수로 처리
+    return await generate_v2_persona_image(uid, final_image, customPersona, prompts, on_result=on_result)
 
-    your name is {persona_data['name']}
+class ClientDisconnected(Exception):
+    pass
 
-    personality : {persona_data['personality']}
 
-    speech : {persona_data['speechStyle']} 
-"""
+async def cancel_on_disconnect(coro, disconnected):
+    """
+    coro 를 실행하다가 disconnected() 가 먼저 끝나면(클라이언트가 떠나면) coro 를 취소하고 ClientDisconnected 를 올린다.
+    취소는 아래로 전파되어 남은 감정의 ComfyUI prompt 를 지우거나 중단시키고 Storage / Firestore 쓰기를 건너뛴다.
+    """
+    work = asyncio.create_task(coro)
+    watcher = asyncio.create_task(disconnected())
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        work.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if not work.done():
+        work.cancel()
+        # 취소 처리(ComfyUI prompt 삭제 예약 등)가 끝날 때까지 기다린다
+        await asyncio.wait({work})
+        raise ClientDisconnected()
+    return work.result()
+
 
-    prompt['clone'] = 'color'
+def http_disconnected(request: Request, interval: float = 1.0):
+    async def wait():
+        while not await request.is_disconnected():
+            await asyncio.sleep(interval)
+    return wait
 
+
+def websocket_disconnected(websocket: WebSocket):
+    async def wait():
+        # 이 엔드포인트는 첫 메시지 뒤로는 받을 것이 없으므로 연결 종료만 기다린다
+        while (await websocket.receive())['type'] != 'websocket.disconnect':
+            pass
+    return wait
+
+
+async def run_persona_job(job, on_result):
+    return await generate_persona_for_user(job.uid, job.payload['customPersona'], job.image, on_result)
+
+@app.post("/generate-persona-images")
+async def generate_persona_images(
+    request: Request,
+    image: Optional[UploadFile] = File(None),
+    customPersona: str = Form(...),
+    uid: str = Form(...)
+):
     try:
-        final_image = None
-        
-        if image:
-            # UploadFile을 PIL Image로 변환
-            contents = await image.read()
-            final_image = Image.open(BytesIO(contents))
-        else:
-            # 기본 이미지 로드
-            gender = user_ref['profile']['gender']
-            image_path = 'assets/images/male.jpg' if gender == 'male' else 'assets/images/female.webp'
-            final_image = Image.open(image_path)
-        
-        # 이제 동일한 함수로 처리
-        return await generate_v2_persona_image(uid, final_image, customPersona, prompt ,db)
-        
+        contents = await image.read() if image else None
+        return await cancel_on_disconnect(
+            generate_persona_for_user(uid, customPersona, contents), http_disconnected(request),
+        )
+
+    except ClientDisconnected:
+        logger.info("클라이언트 연결이 끊겨 페르소나 생성을 취소했습니다 uid=%s", uid)
+        return {"status": "cancelled"}
+    except HTTPException as e:
+        logger.error("Error: %s", e)
+        if e.status_code == 500:
+            return {"error": str(e)}
+        # 너무 크거나 읽을 수 없는 사진(413 / 400), 일시적인 거절(503) 등은 같은 본문 모양에 상태 코드만 살려서 돌려준다
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
     except Exception as e:
-        print(f"Error: {str(e)}")
+        logger.error("Error: %s", e)
         return {"error": str(e)}
-async def regenerate_image_endpoint(emotion: str, image : UploadFile=File(...)):
-    return await regenerate_image(emotion, image)
+
+@app.post("/jobs/persona-images", status_code=202)
+async def submit_persona_images_job(
+    image: Optional[UploadFile] = File(None),
+    customPersona: str = Form(...),
+    uid: str = Form(...)
+):
+    # 생성이 끝날 때까지 연결을 붙잡지 않고 작업 id만 바로 돌려준다
+    contents = await image.read() if image else None
+    job = await app.state.jobs.submit("persona-images", uid, {"customPersona": customPersona}, contents)
+    return {"job_id": job.id, "status": job.status}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.post("/regenerate-image/{emotion}")
+async def regenerate_image_endpoint(
+    request: Request,
+    emotion: str,
+    image: UploadFile = File(...),
+    candidates: int = Form(1),
+    priority: bool = Form(True),
+):
+    # 후보 여러 장을 한 번의 batch 샘플링으로 만들어 사용자가 고르게 한다.
+    # priority 요청은 ComfyUI 큐의 맨 앞에 들어가 페르소나 생성 작업 뒤에서 기다리지 않는다.
+    try:
+        return await cancel_on_disconnect(
+            regenerate_image(emotion, image, candidates, priority), http_disconnected(request),
+        )
+    except ClientDisconnected:
+        logger.info("클라이언트 연결이 끊겨 다시 만들기를 취소했습니다 emotion=%s", emotion)
+        return {"status": "cancelled"}
 
 
 
 @app.get("/networkcheck")
 async def network_check_endpoint():
-    print("network_check_endpoint 호출")
+    logger.debug("network_check_endpoint 호출")
     return {"message": "Network check successful"}
 
+@app.get("/readiness")
+async def readiness_endpoint():
+    # /networkcheck 는 프로세스가 살아 있는지만, 이곳은 ComfyUI 모델이 올라가 있어 바로 생성할 수 있는지를 알려준다
+    warmup = app.state.warmup
+    body = {"status": "ready" if warmup.ready else "warming", "backends": warmup.metrics()}
+    return JSONResponse(body, status_code=200 if warmup.ready else 503)
+
+@app.get("/comfyui/pool")
+async def comfyui_pool_endpoint():
+    return {"backends": app.state.comfyui.metrics(), "result_cache": result_cache.metrics()}
+
+def require_admin(authorization: Optional[str]):
+    """관리용 API 요청의 토큰을 확인한다. ADMIN_TOKEN 이 없으면 그런 API 가 없는 것처럼 404 를 돌려준다."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
+@app.post("/comfyui/pool/drain")
+async def comfyui_drain_endpoint(base_url: str = Form(...), draining: bool = Form(True),
+                                 authorization: Optional[str] = Header(None)):
+    # 서버를 빼기 전에 새 prompt 를 보내지 않게 한다 (이미 올라간 prompt 는 끝까지 기다린다). draining=false 로 되돌린다.
+    require_admin(authorization)
+    try:
+        app.state.comfyui.drain(base_url, draining)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown ComfyUI backend: {base_url}")
+    logger.info("ComfyUI backend %s: %s", "draining" if draining else "undrained", base_url)
+    return {"backends": app.state.comfyui.metrics()}
+
+def collect_runtime_metrics():
+    """스크랩할 때마다 ComfyUI 서버 풀 / 캐시 / 작업 큐의 현재 값을 게이지로 만든다."""
+    queue_depth = Gauge('mirror_comfyui_queue_depth', "Prompts running or pending on each ComfyUI backend", ('backend',))
+    inflight = Gauge('mirror_comfyui_inflight', "Prompts this process has assigned to each backend", ('backend',))
+    healthy = Gauge('mirror_comfyui_healthy', "1 if the backend answered the last health check", ('backend',))
+    latency = Gauge('mirror_comfyui_latency_seconds', "EWMA of queue-to-done time per prompt", ('backend',))
+    for backend in app.state.comfyui.backends:
+        queue_depth.set(backend.queue_depth, backend=backend.base_url)
+        inflight.set(backend.inflight, backend=backend.base_url)
+        healthy.set(int(backend.healthy), backend=backend.base_url)
+        if backend.latency is not None:
+            latency.set(backend.latency, backend=backend.base_url)
+
+    upload = Gauge('mirror_upload_cache', "Input image upload cache counters", ('kind',))
+    upload.set(upload_cache.hits, kind='hits')
+    upload.set(upload_cache.misses, kind='misses')
+    results = Gauge('mirror_result_cache', "Generated result cache counters", ('kind',))
+    for kind, value in result_cache.metrics().items():
+        results.set(value, kind=kind)
+    jobs = Gauge('mirror_jobs', "Persona generation jobs", ('state',))
+    jobs.set(app.state.jobs.depth, state='queued')
+    jobs.set(app.state.jobs.running, state='running')
+    warm = Gauge('mirror_comfyui_warm', "1 if the backend finished its warm-up renders", ('backend',))
+    for base_url, status in app.state.warmup.metrics().items():
+        warm.set(int(status['state'] == 'ready'), backend=base_url)
+    personas = Gauge('mirror_persona_store', "Persona document cache and write batching counters", ('kind',))
+    for kind, value in persona_store.metrics().items():
+        personas.set(value, kind=kind)
+    return [queue_depth, inflight, healthy, latency, warm, upload, results, jobs, personas]
+
+registry.add_collector(collect_runtime_metrics)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    # Prometheus 텍스트 형식 (text/plain; version=0.0.4)
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
@@ -99,46 +299,62 @@ async def websocket_endpoint(websocket: WebSocket):
             data = await websocket.receive_text()
             await websocket.send_text(f"서버에서 받은 메시지: {data}")
         except Exception as e:
-            print(f"오류 발생: {str(e)}")
+            logger.info("오류 발생: %s", e)
             break
 
 @app.websocket("/image-generate-default/{uid}")
 async def image_generate_default_websocket(uid: str, websocket: WebSocket):
-    print("image_generate_default_websocket 호출")
-    print(uid)
-    print(websocket)
-    
-    print("===============================")
+    logger.info("image_generate_default_websocket 호출 uid=%s", uid)
     await websocket.accept()
     gender = None
     
     try:
         # 클라이언트로부터 이미지 데이터 수신
         data = await websocket.receive_text()
-        image_data = json.loads(data)
-        print("성별")
-        print(image_data['gender'])
-        
-        if 'image' in image_data and image_data['image']:
-            print(1)
-            # 사용자가 이미지를 보냈을 경우
-            image_bytes = base64.b64decode(image_data['image'])
-            image = Image.open(io.BytesIO(image_bytes))
-            print(image)
-        else:
-            print(2)
-            # 사용자가 이미지를 보내지 않았을 경우
-            default_image = 'female.webp' if image_data['gender'].lower() == 'female' else 'male.jpg'
-            image_path = os.path.join('assets/images/', default_image)
-            print(3)
-            image = Image.open(image_path)
-            print(4,image)
+        with span('request_decode'):
+            image_data = json.loads(data)
+            logger.debug("성별: %s", image_data['gender'])
+
+            if 'image' in image_data and image_data['image']:
+                # 사용자가 이미지를 보냈을 경우. str 을 바로 디코딩해서 encode() 복사를 피한다
+                image = binascii.a2b_base64(image_data['image'])
+                logger.debug("입력 이미지 %d bytes", len(image))
+            else:
+                # 사용자가 이미지를 보내지 않았을 경우
+                default_image = 'female.webp' if image_data['gender'].lower() == 'female' else 'male.jpg'
+                image = os.path.join('assets/images/', default_image)
+                logger.debug("기본 이미지 사용: %s", image)
         
-        # 이미지 처리 또는 저장
-        response = await generate_image_websocket(uid, image)
-        print(4)
+        # 감정별 queued / running / progress 상태와 결과를 끝나는 대로 클라이언트에 보낸다.
+        # 여러 감정 태스크가 동시에 보내지 않도록 큐 하나를 두고 한 태스크가 순서대로 보낸다.
+        events = asyncio.Queue()
 
-        print("response : ", response['images'])
+        async def forward_events():
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                try:
+                    await websocket.send_text(json.dumps(event))
+                except Exception as e:
+                    # 클라이언트가 떠났으면 남은 이벤트는 버린다 (생성 취소는 연결 종료 감시가 맡는다)
+                    logger.debug("진행 이벤트 전송 실패: %s", e)
+                    break
+
+        async def on_result(emotion, result):
+            events.put_nowait({'type': 'result', 'emotion': emotion, **result})
+
+        sender = asyncio.create_task(forward_events())
+        try:
+            # 이미지 처리 또는 저장. 클라이언트가 떠나면 남은 감정 생성을 취소한다.
+            response = await cancel_on_disconnect(
+                generate_image_websocket(uid, image, on_event=events.put_nowait, on_result=on_result),
+                websocket_disconnected(websocket),
+            )
+        finally:
+            events.put_nowait(None)
+            await sender
+        logger.debug("response : %s", response['images'])
 
         if response['status'] == 'complete':
             images = response['images']
@@ -148,13 +364,17 @@ async def image_generate_default_websocket(uid: str, websocket: WebSocket):
                 'joy' : images['joy']['image_url'],
                 'sadness' : images['sadness']['image_url'],
                 'serious' : images['serious']['image_url']
+            },
+            # 감정별 크기 / 형식 변형 URL ({'thumb': {'webp': url}, ...})
+            "personaVariants" : {
+                emotion : images[emotion].get('variants', {})
+                for emotion in ('anger', 'disgust', 'joy', 'sadness', 'serious')
             }
             }
 
-            user_ref = db.collection('users').document(uid)
-            result = user_ref.update(persona_data)
+            # 같은 시간 창에 끝난 다른 사용자들의 쓰기와 함께 트랜잭션 하나로 보낸다
+            await persona_store.update_fields(uid, persona_data)
 
-            print('result ==================================', result)
             # 클라이언트에 성공 응답
             await websocket.send_text(json.dumps({
                 "status": "success",
@@ -168,16 +388,21 @@ async def image_generate_default_websocket(uid: str, websocket: WebSocket):
                 "message": "페르소나 이미지 생성에 실패했습니다."
             }))
         
+    except ClientDisconnected:
+        logger.info("클라이언트 연결이 끊겨 페르소나 생성을 취소했습니다 uid=%s", uid)
+        return
     except Exception as e:
-        print(f"오류 발생: {str(e)}")
+        logger.error("오류 발생: %s", e)
         await websocket.send_text(json.dumps({"status": "error", "message": str(e)}))
     finally:
-        await websocket.close()
+        # 클라이언트가 이미 떠났으면 닫기 메시지를 보낼 수 없다
+        if WebSocketState.DISCONNECTED not in (websocket.client_state, websocket.application_state):
+            await websocket.close()
 
 
 if __name__ == "__main__":
     import uvicorn
-    print("FastAPI 서버 실행")
+    logger.info("FastAPI 서버 실행")
     uvicorn.run(app, host="0.0.0.0", port=1818)
 
 # uvicorn Main:app --host 0.0.0.0 --port 1818 --reload
\ No newline at end of file
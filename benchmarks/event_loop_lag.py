@@ -0,0 +1,97 @@
+"""
+동기 Firebase 호출을 이벤트 루프에서 바로 부를 때와 firebase_io 스레드 풀로 넘길 때의
+이벤트 루프 지연(lag)을 비교한다.
+
+실제 Firebase 대신 time.sleep 으로 업로드 / Firestore 호출 시간을 흉내내므로 자격 증명 없이 돌릴 수 있다.
+
+    python -m benchmarks.event_loop_lag --requests 20 --uploads 5 --upload-ms 150
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from firebase_io import run_firebase, shutdown_firebase_io
+
+
+class LoopLagMonitor:
+    """interval 마다 깨어나서 예정보다 얼마나 늦게 깨어났는지를 기록한다."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def summary(self) -> dict:
+        if not self.samples:
+            return {'samples': 0}
+        ordered = sorted(self.samples)
+        return {
+            'samples': len(ordered),
+            'mean_ms': statistics.mean(ordered) * 1000,
+            'p99_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+            'max_ms': ordered[-1] * 1000,
+        }
+
+
+def blocking_call(seconds: float):
+    # blob.upload_from_file / make_public / document.get 같은 동기 네트워크 호출 대역
+    time.sleep(seconds)
+
+
+async def persona_request(offload: bool, uploads: int, upload_seconds: float, firestore_seconds: float):
+    async def call(seconds):
+        if offload:
+            await run_firebase(blocking_call, seconds)
+        else:
+            blocking_call(seconds)
+
+    await call(firestore_seconds)  # users/{uid} 읽기
+    await asyncio.gather(*(call(upload_seconds) for _ in range(uploads)))  # 감정별 업로드
+    await call(firestore_seconds)  # persona 쓰기
+
+
+async def run(offload: bool, requests: int, uploads: int, upload_seconds: float, firestore_seconds: float) -> dict:
+    monitor = LoopLagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(persona_request(offload, uploads, upload_seconds, firestore_seconds) for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    await monitor.stop()
+    return {'elapsed_s': elapsed, **monitor.summary()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Event loop lag: inline vs offloaded Firebase calls")
+    parser.add_argument('--requests', type=int, default=20, help="동시에 처리할 페르소나 요청 수")
+    parser.add_argument('--uploads', type=int, default=5, help="요청당 이미지 업로드 수")
+    parser.add_argument('--upload-ms', type=float, default=150)
+    parser.add_argument('--firestore-ms', type=float, default=40)
+    args = parser.parse_args()
+
+    for label, offload in (('inline (before)', False), ('firebase_io (after)', True)):
+        result = asyncio.run(run(offload, args.requests, args.uploads, args.upload_ms / 1000, args.firestore_ms / 1000))
+        print(f"{label:22s} elapsed={result['elapsed_s']:.2f}s "
+              f"lag mean={result.get('mean_ms', 0):.1f}ms p99={result.get('p99_ms', 0):.1f}ms max={result.get('max_ms', 0):.1f}ms")
+    shutdown_firebase_io()
+
+
+if __name__ == "__main__":
+    main()
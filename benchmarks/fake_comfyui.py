@@ -0,0 +1,254 @@
+"""
+로컬 테스트용 가짜 ComfyUI 서버.
+
+실제 GPU 없이 generate_image.py 의 ComfyUI 연동을 확인할 수 있도록
+ComfyUI와 같은 모양의 응답과 웹소켓 이벤트를 흉내낸다.
+
+    python -m benchmarks.fake_comfyui --port 8188 --sample-delay 2
+    COMFYUI_URL=http://127.0.0.1:8188 uvicorn Main:app --port 1818
+"""
+import argparse
+import asyncio
+import json
+import uuid
+from io import BytesIO
+
+from aiohttp import web
+from PIL import Image
+
+
+class FakeComfyUI:
+    def __init__(self, sample_delay: float = 1.0, steps: int = 5, front_delay: float = 0.0, load_delay: float = 0.0):
+        self.sample_delay = sample_delay
+        self.steps = steps
+        # 로더 / LoadImage / 태거 같은 앞부분을 실행하는 시간. ComfyUI 처럼 직전 prompt와
+        # 입력 이미지가 같으면 캐시된 것으로 보고 건너뛴다.
+        self.front_delay = front_delay
+        # 처음 보는 체크포인트를 VRAM 에 올리는 시간. 한 번 올린 모델은 계속 남아 있는 것으로 본다.
+        self.load_delay = load_delay
+        self.loaded_models = set()
+        self._last_inputs = None
+        self.pending = []  # [(number, prompt_id, graph, client_id)]
+        self.running = None
+        self._wakeup = asyncio.Event()
+        self.history = {}
+        self.sockets = {}  # client_id -> WebSocketResponse
+        self.prompt_count = 0
+        self.uploads = {}  # "subfolder/name" -> bytes
+        self.outputs = set()
+        self.deleted = 0
+        self.interrupted = 0
+        self._interrupt = asyncio.Event()
+        self.output_png = self._render_output()
+        self._worker = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/upload/image', self.handle_upload)
+        app.router.add_post('/prompt', self.handle_prompt)
+        app.router.add_get('/queue', self.handle_queue)
+        app.router.add_post('/queue', self.handle_queue_delete)
+        app.router.add_post('/interrupt', self.handle_interrupt)
+        app.router.add_get('/history', self.handle_history_all)
+        app.router.add_get('/history/{prompt_id}', self.handle_history)
+        app.router.add_get('/view', self.handle_view)
+        app.router.add_get('/ws', self.handle_ws)
+        app.on_startup.append(self._start_worker)
+        app.on_cleanup.append(self._stop_worker)
+        return app
+
+    async def _start_worker(self, app):
+        self._worker = asyncio.create_task(self._run())
+
+    async def _stop_worker(self, app):
+        self._worker.cancel()
+
+    async def handle_upload(self, request):
+        form = await request.post()
+        image = form['image']
+        subfolder = form.get('subfolder', '')
+        name = image.filename
+        self.uploads[f"{subfolder}/{name}" if subfolder else name] = image.file.read()
+        return web.json_response({'name': name, 'subfolder': subfolder, 'type': 'input'})
+
+    async def handle_prompt(self, request):
+        body = await request.json()
+        graph = body.get('prompt', {})
+        for node_id, node in graph.items():
+            if node.get('class_type') == 'LoadImage' and node['inputs'].get('image') not in self.uploads:
+                error = {'type': 'prompt_outputs_failed_validation', 'message': f"Invalid image file: {node['inputs'].get('image')}"}
+                return web.json_response({'error': error, 'node_errors': {node_id: error}}, status=400)
+        prompt_id = str(uuid.uuid4())
+        self.prompt_count += 1
+        item = (self.prompt_count, prompt_id, graph, body.get('client_id', ''))
+        if body.get('front'):
+            self.pending.insert(0, item)
+        else:
+            self.pending.append(item)
+        self._wakeup.set()
+        return web.json_response({'prompt_id': prompt_id, 'number': self.prompt_count, 'node_errors': {}})
+
+    @staticmethod
+    def _queue_item(item):
+        number, prompt_id, graph, client_id = item
+        return [number, prompt_id, graph, {'client_id': client_id}, []]
+
+    async def handle_queue(self, request):
+        return web.json_response({
+            'queue_running': [self._queue_item(self.running)] if self.running else [],
+            'queue_pending': [self._queue_item(item) for item in self.pending],
+        })
+
+    async def handle_queue_delete(self, request):
+        body = await request.json()
+        if body.get('clear'):
+            self.deleted += len(self.pending)
+            self.pending.clear()
+        delete = set(body.get('delete', ()))
+        if delete:
+            before = len(self.pending)
+            self.pending = [item for item in self.pending if item[1] not in delete]
+            self.deleted += before - len(self.pending)
+        return web.Response(status=200)
+
+    async def handle_interrupt(self, request):
+        body = await request.json() if request.can_read_body else {}
+        prompt_id = body.get('prompt_id')
+        # 새 ComfyUI 처럼 prompt_id 가 지금 실행 중인 것과 다르면 무시한다
+        if self.running is not None and (prompt_id is None or prompt_id == self.running[1]):
+            self._interrupt.set()
+        return web.Response(status=200)
+
+    async def handle_history_all(self, request):
+        return web.json_response(self.history)
+
+    async def handle_history(self, request):
+        prompt_id = request.match_info['prompt_id']
+        if prompt_id in self.history:
+            return web.json_response({prompt_id: self.history[prompt_id]})
+        return web.json_response({})
+
+    @staticmethod
+    def _render_output(size: int = 512) -> bytes:
+        buffer = BytesIO()
+        Image.new('RGB', (size, size), (255, 220, 120)).save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    async def handle_view(self, request):
+        filename = request.query.get('filename', '')
+        if request.query.get('type', 'output') != 'output' or filename not in self.outputs:
+            return web.Response(status=404)
+        return web.Response(body=self.output_png, content_type='image/png')
+
+    async def handle_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get('clientId') or uuid.uuid4().hex
+        self.sockets[client_id] = ws
+        await ws.send_str(json.dumps({'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': len(self.pending)}}, 'sid': client_id}}))
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            if self.sockets.get(client_id) is ws:
+                del self.sockets[client_id]
+        return ws
+
+    async def _send(self, client_id: str, msg_type: str, data: dict):
+        ws = self.sockets.get(client_id)
+        if ws is not None and not ws.closed:
+            await ws.send_str(json.dumps({'type': msg_type, 'data': data}))
+
+    @staticmethod
+    def batch_size(graph: dict) -> int:
+        sizes = [node['inputs'].get('batch_size', 1) for node in graph.values() if node.get('class_type') == 'EmptyLatentImage']
+        return max(sizes, default=1)
+
+    @staticmethod
+    def sampling_steps(graph: dict) -> int:
+        # 워크플로 기본값(30 step)을 기준으로 샘플링 시간을 줄인다 (워밍업 같은 적은 step 실행)
+        steps = [node['inputs'].get('steps', 30) for node in graph.values() if node.get('class_type') == 'KSamplerAdvanced']
+        return max(steps, default=30)
+
+    def output_nodes(self, graph: dict):
+        return [node_id for node_id, node in graph.items() if node.get('class_type') == 'SaveImage']
+
+    async def execute(self, prompt_id: str, graph: dict, client_id: str):
+        outputs = {}
+        await self._send(client_id, 'execution_start', {'prompt_id': prompt_id})
+        inputs = sorted(node['inputs'].get('image') for node in graph.values() if node.get('class_type') == 'LoadImage')
+        if self.front_delay and inputs != self._last_inputs:
+            await asyncio.sleep(self.front_delay)
+        self._last_inputs = inputs
+        models = {node['inputs'].get('ckpt_name') for node in graph.values() if node.get('class_type') == 'CheckpointLoaderSimple'}
+        if self.load_delay and not models <= self.loaded_models:
+            await asyncio.sleep(self.load_delay)
+        self.loaded_models |= models
+        step_delay = self.sample_delay * min(1.0, self.sampling_steps(graph) / 30) / self.steps
+        for node_id in self.output_nodes(graph):
+            await self._send(client_id, 'executing', {'node': node_id, 'prompt_id': prompt_id})
+            for step in range(1, self.steps + 1):
+                try:
+                    await asyncio.wait_for(self._interrupt.wait(), step_delay)
+                except asyncio.TimeoutError:
+                    pass
+                else:
+                    raise InterruptedError(prompt_id)
+                await self._send(client_id, 'progress', {'value': step, 'max': self.steps, 'prompt_id': prompt_id, 'node': node_id})
+            images = []
+            for _ in range(self.batch_size(graph)):
+                filename = f"ComfyUI_{uuid.uuid4().hex[:8]}_.png"
+                self.outputs.add(filename)
+                images.append({'filename': filename, 'subfolder': '', 'type': 'output'})
+            output = {'images': images}
+            outputs[node_id] = output
+            await self._send(client_id, 'executed', {'node': node_id, 'output': output, 'prompt_id': prompt_id})
+        return outputs
+
+    async def _run(self):
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self.running = self.pending.pop(0)
+            number, prompt_id, graph, client_id = self.running
+            self._interrupt.clear()
+            try:
+                outputs = await self.execute(prompt_id, graph, client_id)
+                status = {'status_str': 'success', 'completed': True, 'messages': []}
+            except InterruptedError:
+                self.interrupted += 1
+                outputs = {}
+                status = {'status_str': 'error', 'completed': False, 'messages': [['execution_interrupted', {'prompt_id': prompt_id}]]}
+                await self._send(client_id, 'execution_interrupted', {'prompt_id': prompt_id})
+            finally:
+                self.running = None
+            self.history[prompt_id] = {
+                'prompt': [number, prompt_id, graph, {'client_id': client_id}, self.output_nodes(graph)],
+                'outputs': outputs,
+                'status': status,
+            }
+            if status['completed']:
+                # 실제 ComfyUI 처럼 execution_success 를 보낸 뒤 executing(None) 을 보낸다
+                await self._send(client_id, 'execution_success', {'prompt_id': prompt_id})
+                await self._send(client_id, 'executing', {'node': None, 'prompt_id': prompt_id})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake ComfyUI server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8188)
+    parser.add_argument('--sample-delay', type=float, default=1.0, help="SaveImage 노드 하나를 만드는 데 걸리는 시간(초)")
+    parser.add_argument('--steps', type=int, default=5, help="progress 이벤트 수")
+    parser.add_argument('--front-delay', type=float, default=0.0, help="입력 이미지가 바뀔 때 앞부분 노드를 다시 실행하는 시간(초)")
+    parser.add_argument('--load-delay', type=float, default=0.0, help="처음 쓰는 체크포인트를 불러오는 시간(초)")
+    args = parser.parse_args()
+
+    server = FakeComfyUI(sample_delay=args.sample_delay, steps=args.steps, front_delay=args.front_delay,
+                         load_delay=args.load_delay)
+    web.run_app(server.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
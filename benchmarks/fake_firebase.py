@@ -0,0 +1,229 @@
+"""
+부하 테스트용 메모리 Firebase (Storage / Firestore) 대역.
+
+firebase_admin 과 같은 이름의 모듈을 sys.modules 에 넣어서, Main.py 가 자격 증명 파일이나
+네트워크 없이 import 되고 동작하게 한다. 실제 클라이언트처럼 동기 호출이며,
+storage_latency / firestore_latency 만큼 time.sleep 해서 네트워크 시간을 흉내낸다.
+
+    from benchmarks.fake_firebase import install
+    firebase = install(storage_latency=0.15, firestore_latency=0.05)  # Main 을 import 하기 전에 불러야 한다
+    import Main
+"""
+import copy
+import sys
+import threading
+import time
+import types
+
+
+class FakeBlob:
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = None
+        self.content_type = None
+
+    def upload_from_file(self, file_obj, content_type=None, rewind=False):
+        if rewind:
+            file_obj.seek(0)
+        data = file_obj.read()
+        time.sleep(self.bucket.latency)
+        self.content_type = content_type
+        with self.bucket.lock:
+            self.bucket.blobs[self.name] = data
+
+    def make_public(self):
+        time.sleep(self.bucket.latency)
+
+    @property
+    def public_url(self) -> str:
+        return f"https://storage.fake/{self.bucket.name}/{self.name}"
+
+
+class FakeBucket:
+    def __init__(self, name: str, latency: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.blobs = {}  # blob 이름 -> bytes
+        self.lock = threading.Lock()
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id: str, data):
+        self.id = doc_id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class FakeDocumentReference:
+    def __init__(self, store, collection: str, doc_id: str):
+        self.store = store
+        self.collection = collection
+        self.id = doc_id
+
+    @property
+    def path(self) -> str:
+        return f"{self.collection}/{self.id}"
+
+    def get(self, transaction=None) -> FakeSnapshot:
+        time.sleep(self.store.latency)
+        with self.store.lock:
+            self.store.reads += 1
+            return FakeSnapshot(self.id, self.store.documents.get(self.path))
+
+    def set(self, data: dict, merge: bool = False):
+        time.sleep(self.store.latency)
+        with self.store.lock:
+            self.store.writes += 1
+            self._set(data, merge)
+
+    def _set(self, data: dict, merge: bool):
+        current = self.store.documents.get(self.path) if merge else None
+        # merge=True 는 Firestore 처럼 중첩 map 을 필드 단위로 합친다 (배열은 통째로 바꾼다)
+        self.store.documents[self.path] = deep_merge(current or {}, copy.deepcopy(data))
+
+    def update(self, data: dict):
+        time.sleep(self.store.latency)
+        with self.store.lock:
+            self.store.writes += 1
+            current = self.store.documents.get(self.path)
+            if current is None:
+                raise KeyError(f"No document to update: {self.path}")
+            for field, value in data.items():
+                # "profile.gender" 같은 점 경로는 중첩 필드를 바꾼다
+                *parents, leaf = field.split('.')
+                target = current
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                target[leaf] = copy.deepcopy(value)
+
+
+def deep_merge(current: dict, data: dict) -> dict:
+    merged = dict(current)
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = deep_merge(merged[key], value)
+        merged[key] = value
+    return merged
+
+
+class FakeTransaction:
+    """쓰기를 모아 두었다가 commit 때 한꺼번에 반영한다 (왕복 한 번)."""
+
+    def __init__(self, store):
+        self.store = store
+        self._writes = []
+
+    def set(self, ref, data: dict, merge: bool = False):
+        self._writes.append((ref, data, merge))
+
+    def commit(self):
+        time.sleep(self.store.latency)
+        with self.store.lock:
+            self.store.commits += 1
+            self.store.writes += len(self._writes)
+            for ref, data, merge in self._writes:
+                ref._set(data, merge)
+        self._writes = []
+
+
+def transactional(func):
+    def run(transaction, *args, **kwargs):
+        result = func(transaction, *args, **kwargs)
+        transaction.commit()
+        return result
+    return run
+
+
+class FakeCollectionReference:
+    def __init__(self, store, name: str):
+        self.store = store
+        self.name = name
+
+    def document(self, doc_id: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self.store, self.name, doc_id)
+
+
+class FakeFirestore:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.documents = {}  # "collection/doc_id" -> dict
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.writes = 0
+        self.commits = 0
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def transaction(self) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def get_all(self, refs, transaction=None):
+        # 여러 문서를 왕복 한 번으로 읽는다
+        time.sleep(self.latency)
+        with self.lock:
+            self.reads += len(refs)
+            return [FakeSnapshot(ref.id, self.documents.get(ref.path)) for ref in refs]
+
+
+class FakeFirebase:
+    """설치된 대역의 상태. 부하 테스트가 끝난 뒤 업로드 / 읽기 / 쓰기 수를 확인할 때 쓴다."""
+
+    def __init__(self, storage_latency: float = 0.0, firestore_latency: float = 0.0):
+        self.bucket = FakeBucket('fake-bucket', storage_latency)
+        self.firestore = FakeFirestore(firestore_latency)
+
+    def modules(self) -> dict:
+        package = types.ModuleType('firebase_admin')
+        package.__path__ = []
+
+        credentials = types.ModuleType('firebase_admin.credentials')
+        credentials.Certificate = lambda path: {'path': path}
+
+        storage = types.ModuleType('firebase_admin.storage')
+        storage.bucket = lambda name=None, app=None: self.bucket
+
+        firestore = types.ModuleType('firebase_admin.firestore')
+        firestore.client = lambda app=None: self.firestore
+        firestore.transactional = transactional
+
+        def initialize_app(credential=None, options=None, name='[DEFAULT]'):
+            if options and options.get('storageBucket'):
+                self.bucket.name = options['storageBucket']
+            return types.SimpleNamespace(name=name, options=options or {})
+
+        package.initialize_app = initialize_app
+        package.credentials = credentials
+        package.storage = storage
+        package.firestore = firestore
+        return {
+            'firebase_admin': package,
+            'firebase_admin.credentials': credentials,
+            'firebase_admin.storage': storage,
+            'firebase_admin.firestore': firestore,
+        }
+
+    def stats(self) -> dict:
+        return {
+            'storage_blobs': len(self.bucket.blobs),
+            'firestore_reads': self.firestore.reads,
+            'firestore_writes': self.firestore.writes,
+            'firestore_commits': self.firestore.commits,
+        }
+
+
+def install(storage_latency: float = 0.0, firestore_latency: float = 0.0) -> FakeFirebase:
+    """sys.modules 의 firebase_admin 을 메모리 대역으로 바꾼다. 이미 import 된 모듈에는 영향이 없다."""
+    firebase = FakeFirebase(storage_latency, firestore_latency)
+    sys.modules.update(firebase.modules())
+    return firebase
@@ -0,0 +1,236 @@
+"""
+Main.py 전체(FastAPI 앱)를 가짜 ComfyUI 서버와 메모리 Firebase 대역 위에 띄워 놓고
+/generate-persona-images (multipart) 와 /image-generate-default/{uid} (웹소켓)를
+정해진 동시성으로 호출해서 요청 지연 p50/p95/p99, 처리량, 이벤트 루프 지연을 잰다.
+
+앱은 별도 스레드의 이벤트 루프에서 돌고 이벤트 루프 지연은 그 루프에서만 잰다.
+요청을 보내는 쪽과 가짜 ComfyUI 는 메인 스레드의 루프에서 돈다.
+저장소 루트(workflow.json 이 있는 곳)에서 실행한다.
+
+    python -m benchmarks.load_test --endpoint both --requests 40 --concurrency 8 --backends 2 --sample-delay 0.2
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+import aiohttp
+from aiohttp import web
+from PIL import Image
+
+from benchmarks import fake_firebase
+from benchmarks.event_loop_lag import LoopLagMonitor
+from benchmarks.fake_comfyui import FakeComfyUI
+
+EMOTIONS_PER_REQUEST = 5
+CUSTOM_PERSONA = {
+    'name': "테스트",
+    'personality': "밝고 호기심이 많다",
+    'speechStyle': "반말, 짧은 문장",
+}
+
+
+def percentile(ordered: list, q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def make_face(index: int, size: int) -> bytes:
+    """요청마다 다른 입력 이미지. 결과 캐시가 같은 이미지를 건너뛰지 않도록 색을 바꾼다."""
+    rng = random.Random(index)
+    color = (rng.randrange(150, 255), rng.randrange(90, 200), rng.randrange(60, 160))
+    buffer = BytesIO()
+    Image.new('RGB', (size, size), color).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+class AppServer:
+    """uvicorn 으로 Main.app 을 별도 스레드의 이벤트 루프에서 실행한다."""
+
+    def __init__(self, app, port: int):
+        import uvicorn
+
+        self.server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning', lifespan='on'))
+        self.lag = LoopLagMonitor()
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(),), name="load-test-app", daemon=True)
+
+    async def _serve(self):
+        self.lag.start()
+        try:
+            await self.server.serve()
+        finally:
+            await self.lag.stop()
+
+    async def start(self):
+        self._thread.start()
+        while not self.server.started:
+            if not self._thread.is_alive():
+                raise RuntimeError("app server failed to start")
+            await asyncio.sleep(0.05)
+
+    async def stop(self):
+        self.server.should_exit = True
+        await asyncio.get_running_loop().run_in_executor(None, self._thread.join)
+
+
+async def persona_images_http(session, base_url: str, uid: str, image) -> bool:
+    form = aiohttp.FormData()
+    form.add_field('customPersona', json.dumps(CUSTOM_PERSONA, ensure_ascii=False))
+    form.add_field('uid', uid)
+    if image is not None:
+        form.add_field('image', image, filename='face.jpg', content_type='image/jpeg')
+    async with session.post(f"{base_url}/generate-persona-images", data=form) as response:
+        body = await response.json()
+    return response.status == 200 and body.get('status') == 'complete'
+
+
+async def persona_images_ws(session, base_url: str, uid: str, image) -> bool:
+    message = {'gender': 'female', 'image': base64.b64encode(image).decode() if image is not None else ''}
+    async with session.ws_connect(f"{base_url}/image-generate-default/{uid}") as ws:
+        await ws.send_str(json.dumps(message))
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                break
+            event = json.loads(msg.data)
+            # 진행 이벤트 / 감정별 결과에는 'type' 이 있고, 마지막 응답에는 없다
+            if 'type' not in event and 'status' in event:
+                return event['status'] == 'success'
+    return False
+
+
+async def wait_ready(base_url: str, timeout: float) -> float:
+    """/readiness 가 200 이 될 때까지 (워밍업이 끝날 때까지) 기다리고 걸린 시간을 반환한다."""
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        while True:
+            async with session.get(f"{base_url}/readiness") as response:
+                if response.status == 200:
+                    return time.perf_counter() - started
+            if time.perf_counter() - started > timeout:
+                raise RuntimeError("app did not become ready")
+            await asyncio.sleep(0.1)
+
+
+async def drive(args, base_url: str) -> dict:
+    calls = {'http': persona_images_http, 'ws': persona_images_ws}
+    endpoints = ['http', 'ws'] if args.endpoint == 'both' else [args.endpoint]
+    results = {endpoint: {'latencies': [], 'ok': 0, 'errors': 0} for endpoint in endpoints}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+
+    async def one(index: int, session):
+        endpoint = endpoints[index % len(endpoints)]
+        image = None if args.default_image else make_face(0 if args.same_image else index, args.image_size)
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                ok = await calls[endpoint](session, base_url, f"load-{index}", image)
+            except Exception as e:
+                print(f"request {index} ({endpoint}) failed: {e!r}")
+                ok = False
+            results[endpoint]['latencies'].append(time.perf_counter() - started)
+            results[endpoint]['ok' if ok else 'errors'] += 1
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(index, session) for index in range(args.requests)))
+        elapsed = time.perf_counter() - started
+    return {'elapsed_s': elapsed, 'endpoints': results}
+
+
+async def run(args) -> dict:
+    # Main 과 generate_image 가 import 할 때 읽는 설정은 import 전에 정한다
+    backend_ports = [args.comfyui_port + i for i in range(args.backends)]
+    os.environ['COMFYUI_URLS'] = ','.join(f"http://127.0.0.1:{port}" for port in backend_ports)
+    os.environ['JOBS_DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix="load-test-"), "jobs.sqlite3")
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if args.no_result_cache:
+        os.environ['RESULT_CACHE_ENABLED'] = '0'
+    firebase = fake_firebase.install(args.storage_ms / 1000, args.firestore_ms / 1000)
+
+    backends = []
+    runners = []
+    for port in backend_ports:
+        fake = FakeComfyUI(sample_delay=args.sample_delay, steps=args.steps, front_delay=args.front_delay,
+                           load_delay=args.load_delay)
+        runner = web.AppRunner(fake.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        backends.append(fake)
+        runners.append(runner)
+
+    import Main
+
+    for index in range(args.requests):
+        firebase.firestore.documents[f"users/load-{index}"] = {'profile': {'gender': 'female'}, 'persona': []}
+
+    server = AppServer(Main.app, args.port)
+    await server.start()
+    try:
+        base_url = f"http://127.0.0.1:{args.port}"
+        warmup_s = await wait_ready(base_url, args.timeout)
+        warmup_prompts = sum(fake.prompt_count for fake in backends)
+        server.lag.samples.clear()  # 시작 과정(워크플로 로드, 풀 생성, 워밍업)의 지연은 빼고 잰다
+        result = await drive(args, base_url)
+        result['warmup_s'] = warmup_s
+        result['lag'] = server.lag.summary()
+    finally:
+        await server.stop()
+        for runner in runners:
+            await runner.cleanup()
+    result['prompts'] = sum(fake.prompt_count for fake in backends) - warmup_prompts
+    result['uploads'] = sum(len(fake.uploads) for fake in backends)
+    result['firebase'] = firebase.stats()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test Main.app against fake ComfyUI / Firebase")
+    parser.add_argument('--endpoint', choices=('http', 'ws', 'both'), default='both',
+                        help="/generate-persona-images(http), /image-generate-default(ws), 또는 번갈아(both)")
+    parser.add_argument('--requests', type=int, default=20, help="보낼 페르소나 요청 수")
+    parser.add_argument('--concurrency', type=int, default=4, help="동시에 진행 중인 요청 수")
+    parser.add_argument('--backends', type=int, default=1, help="가짜 ComfyUI 서버 수")
+    parser.add_argument('--sample-delay', type=float, default=0.2, help="감정 하나의 샘플링 시간(초)")
+    parser.add_argument('--steps', type=int, default=5, help="progress 이벤트 수")
+    parser.add_argument('--front-delay', type=float, default=0.0, help="입력 이미지가 바뀔 때 앞부분 노드 실행 시간(초)")
+    parser.add_argument('--load-delay', type=float, default=0.0, help="가짜 ComfyUI 가 처음 쓰는 체크포인트를 불러오는 시간(초)")
+    parser.add_argument('--storage-ms', type=float, default=100, help="Storage 업로드 / make_public 호출 시간")
+    parser.add_argument('--firestore-ms', type=float, default=30, help="Firestore 읽기 / 쓰기 호출 시간")
+    parser.add_argument('--image-size', type=int, default=1024, help="보낼 입력 사진의 한 변 픽셀 수")
+    parser.add_argument('--default-image', action='store_true', help="사진 없이 보내서 기본 아바타를 쓰게 한다")
+    parser.add_argument('--same-image', action='store_true', help="모든 요청에 같은 사진을 보낸다 (캐시 효과 확인용)")
+    parser.add_argument('--no-result-cache', action='store_true', help="RESULT_CACHE_ENABLED=0 으로 실행")
+    parser.add_argument('--timeout', type=float, default=600, help="요청 하나의 제한 시간(초)")
+    parser.add_argument('--port', type=int, default=18818)
+    parser.add_argument('--comfyui-port', type=int, default=18388, help="첫 가짜 ComfyUI 포트 (서버마다 1씩 늘린다)")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    elapsed = result['elapsed_s']
+    print(f"requests={args.requests} concurrency={args.concurrency} backends={args.backends} elapsed={elapsed:.2f}s "
+          f"throughput={args.requests / elapsed:.2f} req/s ({args.requests * EMOTIONS_PER_REQUEST / elapsed:.2f} images/s)")
+    for endpoint, stats in result['endpoints'].items():
+        ordered = sorted(stats['latencies'])
+        print(f"{endpoint:4s} ok={stats['ok']:3d} errors={stats['errors']:3d} "
+              f"p50={percentile(ordered, 0.5):.2f}s p95={percentile(ordered, 0.95):.2f}s "
+              f"p99={percentile(ordered, 0.99):.2f}s max={ordered[-1] if ordered else 0:.2f}s")
+    print(f"warm-up {result['warmup_s']:.2f}s before traffic")
+    lag = result['lag']
+    print(f"app loop lag mean={lag.get('mean_ms', 0):.1f}ms p99={lag.get('p99_ms', 0):.1f}ms max={lag.get('max_ms', 0):.1f}ms")
+    firebase = result['firebase']
+    print(f"comfyui prompts={result['prompts']} uploads={result['uploads']} "
+          f"storage blobs={firebase['storage_blobs']} firestore reads={firebase['firestore_reads']} writes={firebase['firestore_writes']} "
+          f"commits={firebase['firestore_commits']}")
+
+
+if __name__ == "__main__":
+    main()
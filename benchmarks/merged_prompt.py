@@ -0,0 +1,93 @@
+"""
+페르소나 하나의 감정 5개를 prompt 5개로 보낼 때와 공통 노드를 합친 prompt 하나로 보낼 때의
+queue-to-done 시간을 가짜 ComfyUI 서버로 비교한다.
+
+여러 페르소나의 prompt 가 한 서버에 섞여 들어오면 ComfyUI 의 노드 캐시에는 직전 prompt 것만 남아 있어서
+prompt 마다 로더 / IPAdapter / 태거 같은 앞부분을 다시 실행하게 된다 (--front-delay 로 흉내낸다).
+--concurrency 는 EMOTION_CONCURRENCY 처럼 페르소나 하나가 동시에 올리는 prompt 수다.
+Storage 업로드는 포함하지 않는다.
+
+    python -m benchmarks.merged_prompt --personas 4 --concurrency 2 --front-delay 1.5 --sample-delay 0.5
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from aiohttp import web
+
+from benchmarks.fake_comfyui import FakeComfyUI
+from comfyui_client import ComfyUIClient
+from comfyui_pool import ComfyUIPool, close_comfyui_pool, start_comfyui_pool
+from comfyui_uploads import InputImage
+from generate_image import character_params, queue_with_input_image
+from workflow_templates import workflow_registry
+
+EMOTIONS = ['joy', 'sadness', 'anger', 'disgust', 'serious']
+
+
+async def persona_separate(template, image: InputImage, concurrency: int) -> float:
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(emotion):
+        params = character_params(emotion)
+        render = lambda image_ref: template.render(image=image_ref, **params)
+        async with semaphore:
+            await queue_with_input_image(render, image, output_node=template.output_node)
+
+    await asyncio.gather(*(one(emotion) for emotion in EMOTIONS))
+    return time.perf_counter() - started
+
+
+async def persona_merged(template, image: InputImage, concurrency: int) -> float:
+    started = time.perf_counter()
+    branches = {emotion: character_params(emotion) for emotion in EMOTIONS}
+    render = lambda image_ref: template.render_branches(branches, image=image_ref)[0]
+    await queue_with_input_image(render, image, output_node=None, units=len(EMOTIONS))
+    return time.perf_counter() - started
+
+
+async def run(mode: str, args) -> dict:
+    fake = FakeComfyUI(sample_delay=args.sample_delay, steps=1, front_delay=args.front_delay)
+    runner = web.AppRunner(fake.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+    await start_comfyui_pool(ComfyUIPool(clients=[ComfyUIClient(f"http://127.0.0.1:{args.port}")]))
+    try:
+        template = workflow_registry.get('persona')
+        persona = persona_merged if mode == 'merged' else persona_separate
+        # 페르소나마다 다른 얼굴 이미지를 쓴다
+        images = [InputImage(f"face-{mode}-{i}".encode()) for i in range(args.personas)]
+        started = time.perf_counter()
+        durations = await asyncio.gather(*(persona(template, image, args.concurrency) for image in images))
+        elapsed = time.perf_counter() - started
+        return {
+            'prompts': fake.prompt_count,
+            'elapsed_s': elapsed,
+            'mean_s': statistics.mean(durations),
+            'max_s': max(durations),
+        }
+    finally:
+        await close_comfyui_pool()
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Five prompts per persona vs one merged prompt")
+    parser.add_argument('--personas', type=int, default=4, help="동시에 들어오는 페르소나 요청 수")
+    parser.add_argument('--concurrency', type=int, default=5, help="페르소나 하나가 동시에 올리는 prompt 수 (separate)")
+    parser.add_argument('--front-delay', type=float, default=1.5, help="앞부분 노드 실행 시간(초)")
+    parser.add_argument('--sample-delay', type=float, default=0.5, help="감정 하나의 샘플링 시간(초)")
+    parser.add_argument('--port', type=int, default=18288)
+    args = parser.parse_args()
+
+    workflow_registry.load_all()
+    for mode in ('separate', 'merged'):
+        result = asyncio.run(run(mode, args))
+        print(f"{mode:9s} prompts={result['prompts']:3d} elapsed={result['elapsed_s']:.2f}s "
+              f"persona queue-to-done mean={result['mean_s']:.2f}s max={result['max_s']:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
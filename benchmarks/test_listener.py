@@ -0,0 +1,66 @@
+"""
+ComfyUIProgressListener 가 끝난 prompt 의 결과를 잃지 않는지 확인한다.
+
+    python -m pytest -q benchmarks/test_listener.py
+"""
+import asyncio
+
+from aiohttp import web
+
+from benchmarks.fake_comfyui import FakeComfyUI
+from comfyui_client import ComfyUIClient
+from comfyui_ws import ComfyUIProgressListener
+
+GRAPH = {
+    "39": {"class_type": "SaveImage", "inputs": {"filename_prefix": "ComfyUI", "images": ["26", 0]}},
+}
+OUTPUT = {'images': [{'filename': 'a.png', 'subfolder': '', 'type': 'output'}]}
+
+
+def test_success_then_executing_none_keeps_outputs():
+    async def run():
+        listener = ComfyUIProgressListener(client=None)
+        for message in (
+            {'type': 'execution_start', 'data': {'prompt_id': 'p'}},
+            {'type': 'executed', 'data': {'node': '39', 'output': OUTPUT, 'prompt_id': 'p'}},
+            {'type': 'execution_success', 'data': {'prompt_id': 'p'}},
+            {'type': 'executing', 'data': {'node': None, 'prompt_id': 'p'}},
+        ):
+            listener._dispatch(message)
+        # 끝난 뒤에 등록한 대기도 출력을 받아야 한다
+        return await listener.wait_for('p', None)
+
+    assert asyncio.run(run()) == {'outputs': {'39': OUTPUT}}
+
+
+def test_late_wait_against_fake_comfyui():
+    async def run():
+        fake = FakeComfyUI(sample_delay=0.05, steps=1)
+        runner = web.AppRunner(fake.make_app())
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        client = ComfyUIClient(f"http://127.0.0.1:{port}")
+        try:
+            await client.start()
+            prompt_id = await client.queue_prompt(GRAPH)
+            first = await client.listener.wait_for(prompt_id, None, timeout=5)
+            while prompt_id not in fake.history:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)  # execution_success 다음의 executing(None) 까지 받게 한다
+            late = await client.listener.wait_for(prompt_id, None, timeout=5)
+        finally:
+            await client.close()
+            await runner.cleanup()
+        return first, late
+
+    first, late = asyncio.run(run())
+    assert '39' in first['outputs']
+    assert late == first
+
+
+if __name__ == "__main__":
+    test_success_then_executing_none_keeps_outputs()
+    test_late_wait_against_fake_comfyui()
+    print("ok")
@@ -0,0 +1,108 @@
+"""
+ComfyUIPool 이 서버를 고르는 규칙과 죽은 서버를 건너뛰는 재시도를 가짜 ComfyUI 서버 두 대로 확인한다.
+
+    python -m pytest -q benchmarks/test_pool.py
+"""
+import asyncio
+
+from aiohttp import web
+
+from benchmarks.fake_comfyui import FakeComfyUI
+from comfyui_client import ComfyUIClient
+from comfyui_pool import ComfyUIPool, close_comfyui_pool, start_comfyui_pool
+from comfyui_uploads import InputImage
+
+FACE = InputImage(b'fake face', 'image/png', 'png')
+
+
+def make_pool(affinity_slack: int = 2) -> ComfyUIPool:
+    clients = [ComfyUIClient(f"http://127.0.0.1:{port}") for port in (1, 2)]
+    return ComfyUIPool(clients=clients, affinity_slack=affinity_slack, drain=())
+
+
+def render(image_ref):
+    return {
+        "12": {"class_type": "LoadImage", "inputs": {"image": image_ref}},
+        "39": {"class_type": "SaveImage", "inputs": {"filename_prefix": "ComfyUI", "images": ["12", 0]}},
+    }
+
+
+def test_pick_prefers_the_shortest_queue():
+    pool = make_pool()
+    first, second = pool.backends
+    first.queue_depth = 3
+    assert pool.pick() is second
+    # 이 프로세스가 배정해 둔 prompt 도 대기열로 친다
+    first.queue_depth = 0
+    with pool.assign(first, 4):
+        assert pool.pick() is second
+
+
+def test_pick_keeps_affinity_within_slack():
+    pool = make_pool(affinity_slack=2)
+    first, second = pool.backends
+    first.queue_depth = 2
+    assert pool.pick(prefer=[first]) is first
+    first.queue_depth = 3
+    assert pool.pick(prefer=[first]) is second
+
+
+def test_pick_skips_draining_and_down_backends():
+    pool = make_pool()
+    first, second = pool.backends
+    first.queue_depth = 5
+    pool.drain(second.base_url)
+    assert pool.pick() is first
+    assert pool.pick(prefer=[second]) is first
+    pool.drain(second.base_url, False)
+    second.mark_down(ConnectionError("gone"))
+    assert pool.pick() is first
+    # 정상 서버가 없으면 방금 실패한 서버를 뺀 나머지에서 고른다
+    first.mark_down(ConnectionError("gone"))
+    assert pool.pick(exclude=[first]) is second
+
+
+def test_queue_retries_on_another_backend_when_one_is_down():
+    from generate_image import queue_with_input_image
+
+    async def run():
+        fakes, runners, urls = [], [], []
+        for _ in range(2):
+            fake = FakeComfyUI(sample_delay=0.05, steps=1)
+            runner = web.AppRunner(fake.make_app(), shutdown_timeout=0.1)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            fakes.append(fake)
+            runners.append(runner)
+            urls.append(f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}")
+
+        clients = [ComfyUIClient(url, retries=0) for url in urls]
+        pool = await start_comfyui_pool(ComfyUIPool(clients=clients, health_interval=60, drain=()))
+        dead, live = pool.backends
+        try:
+            # 스케줄러가 먼저 고르는 서버를 멈춘다
+            live.queue_depth = 3
+            await runners[0].cleanup()
+            result, used = await queue_with_input_image(render, FACE)
+        finally:
+            await close_comfyui_pool()
+            await runners[1].cleanup()
+        return result, used, dead, live, fakes
+
+    result, used, dead, live, fakes = asyncio.run(run())
+    assert used is live
+    assert '39' in result['outputs']
+    assert fakes[0].prompt_count == 0
+    assert fakes[1].prompt_count == 1
+    assert not dead.healthy
+    assert dead.failures == 1
+    assert live.healthy
+
+
+if __name__ == "__main__":
+    test_pick_prefers_the_shortest_queue()
+    test_pick_keeps_affinity_within_slack()
+    test_pick_skips_draining_and_down_backends()
+    test_queue_retries_on_another_backend_when_one_is_down()
+    print("ok")
@@ -0,0 +1,76 @@
+"""
+감정 하나의 prompt 를 만드는 비용을 비교한다.
+
+    before: workflow.json 을 매번 읽어 json.load 하고, 감정마다 copy.deepcopy 한 뒤 필드를 덮어쓴다
+    after : 미리 읽어 둔 WorkflowTemplate.render() 로 슬롯이 가리키는 노드만 복사한다
+
+    python -m benchmarks.workflow_render --iterations 2000
+"""
+import argparse
+import copy
+import json
+import random
+import time
+
+from workflow_templates import NEGATIVE_PROMPT, workflow_registry
+
+EMOTIONS = ['joy', 'sadness', 'anger', 'disgust', 'serious']
+
+
+def legacy_persona(path: str):
+    with open(path, 'r', encoding='utf-8') as file:
+        workflow = json.load(file)
+    prompts = []
+    for emotion in EMOTIONS:
+        graph = copy.deepcopy(workflow)
+        seed = random.randint(0, 2**32 - 1)
+        graph["1"]['inputs']['image'] = "mirror/input.png"
+        graph["25"]["inputs"]["text"] = emotion
+        graph["34"]["inputs"]["text"] = emotion
+        graph["7"]["inputs"]["text"] = NEGATIVE_PROMPT
+        graph["24"]["inputs"]["text"] = NEGATIVE_PROMPT
+        graph["19"]["inputs"]["noise_seed"] = seed
+        graph["28"]["inputs"]["noise_seed"] = seed
+        prompts.append(graph)
+    return prompts
+
+
+def template_persona(name: str):
+    template = workflow_registry.get(name)
+    return [
+        template.render(image="mirror/input.png", positive=emotion, negative=NEGATIVE_PROMPT,
+                        seed=random.randint(0, 2**32 - 1))
+        for emotion in EMOTIONS
+    ]
+
+
+def measure(func, arg, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return (time.perf_counter() - started) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Workflow load+deepcopy vs precompiled template render")
+    parser.add_argument('--iterations', type=int, default=2000, help="페르소나(감정 5개) 생성 반복 횟수")
+    args = parser.parse_args()
+
+    workflow_registry.load_all()
+    for name in workflow_registry.names():
+        template = workflow_registry.get(name)
+        if name == 'persona':
+            # 두 방식이 같은 payload 를 만드는지 먼저 확인한다 (persona_detailer 는 45번 시드도 바꾸므로 제외)
+            random.seed(0)
+            expected = legacy_persona(template.path)
+            random.seed(0)
+            assert template_persona(name) == expected, "render 결과가 기존 방식과 다릅니다"
+
+        before = measure(legacy_persona, template.path, args.iterations)
+        after = measure(template_persona, name, args.iterations)
+        print(f"{name:18s} load+deepcopy={before * 1e6:8.1f}us  render={after * 1e6:8.1f}us  "
+              f"x{before / after:.1f} (per persona, {len(EMOTIONS)} prompts)")
+
+
+if __name__ == "__main__":
+    main()
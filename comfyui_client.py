@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import os
+
+import aiohttp
+from fastapi import HTTPException
+
+from comfyui_ws import ComfyUIProgressListener
+
+logger = logging.getLogger(__name__)
+
+COMFYUI_URL = os.getenv("COMFYUI_URL", "http://127.0.0.1:8188")
+COMFYUI_POOL_LIMIT = int(os.getenv("COMFYUI_POOL_LIMIT", "100"))
+COMFYUI_POOL_LIMIT_PER_HOST = int(os.getenv("COMFYUI_POOL_LIMIT_PER_HOST", "32"))
+COMFYUI_KEEPALIVE_TIMEOUT = float(os.getenv("COMFYUI_KEEPALIVE_TIMEOUT", "30"))
+COMFYUI_CONNECT_TIMEOUT = float(os.getenv("COMFYUI_CONNECT_TIMEOUT", "10"))
+COMFYUI_REQUEST_TIMEOUT = float(os.getenv("COMFYUI_REQUEST_TIMEOUT", "60"))
+COMFYUI_RETRIES = int(os.getenv("COMFYUI_RETRIES", "2"))
+COMFYUI_RETRY_BACKOFF = float(os.getenv("COMFYUI_RETRY_BACKOFF", "0.5"))
+# /view 결과 이미지를 읽는 청크 크기
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+# 다시 보내도 안전한 상태 코드 (ComfyUI 앞단 프록시 재시작 등)
+RETRY_STATUSES = {502, 503, 504}
+
+
+class ComfyUIClient:
+    """
+    ComfyUI 서버 하나에 대한 모든 HTTP / 웹소켓 통신을 맡는 클라이언트.
+
+    keep-alive 커넥션 풀을 가진 aiohttp 세션 하나를 프로세스 전체가 공유하고,
+    연결 오류와 일시적인 5xx 응답은 지수 백오프로 재시도한다.
+    """
+
+    def __init__(self, base_url: str = COMFYUI_URL, limit: int = COMFYUI_POOL_LIMIT,
+                 limit_per_host: int = COMFYUI_POOL_LIMIT_PER_HOST,
+                 keepalive_timeout: float = COMFYUI_KEEPALIVE_TIMEOUT,
+                 connect_timeout: float = COMFYUI_CONNECT_TIMEOUT,
+                 request_timeout: float = COMFYUI_REQUEST_TIMEOUT,
+                 retries: int = COMFYUI_RETRIES, retry_backoff: float = COMFYUI_RETRY_BACKOFF):
+        self.base_url = base_url.rstrip('/')
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=request_timeout, connect=connect_timeout)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+        self._session = None
+        self._connector = None
+        self.listener = ComfyUIProgressListener(self)
+        self._stats = {
+            'requests': 0,
+            'retries': 0,
+            'errors': 0,
+            'connections_created': 0,
+            'connections_reused': 0,
+        }
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=self._connector,
+                timeout=self.timeout,
+                trace_configs=[self._trace_config()],
+            )
+        return self._session
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_connection_create_end(session, ctx, params):
+            self._stats['connections_created'] += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self._stats['connections_reused'] += 1
+
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    async def start(self, connect_timeout: float = 5.0):
+        await self.listener.start(connect_timeout)
+
+    async def close(self):
+        await self.listener.stop()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get_listener(self) -> ComfyUIProgressListener:
+        # lifespan 밖(스크립트 등)에서 쓰는 경우를 위해 처음 필요할 때 연결한다
+        await self.listener.start()
+        return self.listener
+
+    async def request(self, method: str, path: str, *, data_factory=None, idempotent: bool = None, stream_to=None, retries: int = None, **kwargs):
+        """
+        요청을 보내고 (status, body)를 반환한다. body는 JSON이면 dict, 아니면 bytes.
+        stream_to에 파일 객체를 넘기면 200 응답 본문을 청크 단위로 그곳에 쓰고 body로 받은 바이트 수를 돌려준다.
+
+        idempotent가 아닌 요청(기본: GET 외 전부)은 서버에 닿지 못한 연결 실패만 재시도한다.
+        FormData는 한 번만 보낼 수 있으므로 재시도가 필요한 본문은 data_factory로 넘긴다.
+        """
+        url = f"{self.base_url}{path}"
+        if retries is None:
+            retries = self.retries
+        if idempotent is None:
+            idempotent = method == 'GET'
+        retryable = (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.TimeoutError) if idempotent else (aiohttp.ClientConnectorError,)
+        attempt = 0
+        while True:
+            self._stats['requests'] += 1
+            try:
+                if data_factory is not None:
+                    kwargs['data'] = data_factory()
+                async with self.session.request(method, url, **kwargs) as response:
+                    if idempotent and response.status in RETRY_STATUSES and attempt < retries:
+                        raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status)
+                    if stream_to is not None and response.status == 200:
+                        # 재시도 때 앞선 시도에서 받다 만 내용을 지운다
+                        stream_to.seek(0)
+                        stream_to.truncate()
+                        size = 0
+                        async for chunk in response.content.iter_chunked(OUTPUT_CHUNK_SIZE):
+                            stream_to.write(chunk)
+                            size += len(chunk)
+                        stream_to.seek(0)
+                        return response.status, size
+                    if response.content_type == 'application/json':
+                        body = await response.json()
+                    else:
+                        body = await response.read()
+                    return response.status, body
+            except retryable as e:
+                if attempt >= retries:
+                    self._stats['errors'] += 1
+                    raise
+                attempt += 1
+                self._stats['retries'] += 1
+                logger.warning("ComfyUI %s %s 재시도 %d/%d: %r", method, path, attempt, retries, e)
+                await asyncio.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+
+    async def queue_prompt(self, workflow: dict, client_id: str = "", front: bool = False) -> str:
+        payload = {
+            "prompt": workflow,
+            "client_id": client_id or self.listener.client_id,
+        }
+        if front:
+            # 대기 중인 prompt 들보다 먼저 실행한다
+            payload["front"] = True
+        status, body = await self.request('POST', '/prompt', json=payload)
+        if status != 200:
+            raise HTTPException(status_code=status, detail=f"Error queueing prompt: {_text(body)}")
+        return body.get("prompt_id")
+
+    async def get_history(self, prompt_id: str) -> dict:
+        status, body = await self.request('GET', f'/history/{prompt_id}')
+        if status != 200 or not isinstance(body, dict):
+            return {}
+        return body
+
+    async def get_queue(self, retries: int = None) -> dict:
+        status, body = await self.request('GET', '/queue', retries=retries)
+        if status != 200 or not isinstance(body, dict):
+            raise HTTPException(status_code=status, detail=f"Error reading queue: {_text(body)}")
+        return body
+
+    async def prompt_state(self, prompt_id: str, retries: int = None) -> str:
+        """prompt 가 ComfyUI 큐의 어디에 있는지('running' / 'pending'). 큐에 없으면(끝났거나 지워졌으면) None."""
+        queue = await self.get_queue(retries=retries)
+        for state, key in (('running', 'queue_running'), ('pending', 'queue_pending')):
+            if any(len(item) > 1 and item[1] == prompt_id for item in queue.get(key, [])):
+                return state
+        return None
+
+    async def cancel_prompt(self, prompt_id: str) -> str:
+        """
+        아직 시작하지 않은 prompt 는 큐에서 지우고, 이미 실행 중이면 중단시킨다.
+        무엇을 했는지('deleted' / 'interrupted')를 반환한다.
+        """
+        status, body = await self.request('POST', '/queue', json={'delete': [prompt_id]})
+        if status != 200:
+            raise HTTPException(status_code=status, detail=f"Error deleting queued prompt: {_text(body)}")
+        if await self.prompt_state(prompt_id, retries=0) != 'running':
+            return 'deleted'
+        # /interrupt 는 지금 실행 중인 prompt 를 멈춘다. 새 ComfyUI 는 prompt_id 가 다르면 무시한다.
+        status, body = await self.request('POST', '/interrupt', json={'prompt_id': prompt_id})
+        if status != 200:
+            raise HTTPException(status_code=status, detail=f"Error interrupting prompt: {_text(body)}")
+        return 'interrupted'
+
+    async def upload_image(self, data: bytes, filename: str, content_type: str, subfolder: str = "") -> dict:
+        def make_form():
+            form = aiohttp.FormData()
+            form.add_field("image", data, filename=filename, content_type=content_type)
+            form.add_field('overwrite', 'true')
+            if subfolder:
+                form.add_field('subfolder', subfolder)
+            return form
+
+        # 같은 이름으로 덮어쓰는 업로드라서 다시 보내도 안전하다
+        status, body = await self.request('POST', '/upload/image', data_factory=make_form, idempotent=True)
+        if status != 200:
+            raise HTTPException(status_code=status, detail=f"Error uploading image: {_text(body)}")
+        return body
+
+    async def fetch_output(self, image: dict, buffer) -> int:
+        """
+        SaveImage 결과({'filename', 'subfolder', 'type'})를 /view 로 받아 buffer에 스트리밍한다.
+        ComfyUI와 파일시스템을 공유하지 않아도 결과를 가져올 수 있다.
+        """
+        params = {
+            'filename': image['filename'],
+            'subfolder': image.get('subfolder', ''),
+            'type': image.get('type', 'output'),
+        }
+        status, body = await self.request('GET', '/view', params=params, stream_to=buffer)
+        if status != 200:
+            raise HTTPException(status_code=status, detail=f"Error fetching output {image['filename']}: {_text(body)}")
+        return body
+
+    def pool_metrics(self) -> dict:
+        connector = self._connector
+        in_use = idle = 0
+        if connector is not None and not connector.closed:
+            # aiohttp가 공개 API로 풀 상태를 노출하지 않아서 내부 속성을 조심스럽게 읽는다
+            in_use = len(getattr(connector, '_acquired', ()))
+            idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+        return {
+            'base_url': self.base_url,
+            'limit': self.limit,
+            'limit_per_host': self.limit_per_host,
+            'in_use': in_use,
+            'idle': idle,
+            'websocket_connected': self.listener.connected,
+            **self._stats,
+        }
+
+
+def _text(body) -> str:
+    if isinstance(body, (bytes, bytearray)):
+        return body.decode('utf-8', errors='replace')
+    return str(body)
+
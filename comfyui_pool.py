@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import aiohttp
+
+from comfyui_client import COMFYUI_URL, ComfyUIClient
+
+logger = logging.getLogger(__name__)
+
+# 쉼표로 구분한 ComfyUI 서버 목록. 없으면 COMFYUI_URL 하나만 쓴다.
+COMFYUI_URLS = [url.strip() for url in os.getenv("COMFYUI_URLS", COMFYUI_URL).split(',') if url.strip()]
+# 시작할 때부터 새 prompt 를 보내지 않을 서버 목록 (쉼표로 구분). 배포 / 점검 중인 서버를 뺄 때 쓴다.
+COMFYUI_DRAIN = [url.strip().rstrip('/') for url in os.getenv("COMFYUI_DRAIN", "").split(',') if url.strip()]
+COMFYUI_HEALTH_INTERVAL = float(os.getenv("COMFYUI_HEALTH_INTERVAL", "5"))
+# 입력 이미지가 이미 올라가 있는 서버는 대기열이 이만큼 더 길어도 그대로 고른다
+COMFYUI_AFFINITY_SLACK = int(os.getenv("COMFYUI_AFFINITY_SLACK", "2"))
+# 처음 지연 시간을 모를 때 쓰는 prompt 하나의 예상 처리 시간(초)
+DEFAULT_PROMPT_SECONDS = 20.0
+LATENCY_EWMA_ALPHA = 0.3
+
+
+class ComfyUIBackend:
+    """ComfyUI 서버 하나와 스케줄링에 쓰는 상태(대기열 길이, 상태, 최근 지연 시간)"""
+
+    def __init__(self, client: ComfyUIClient):
+        self.client = client
+        self.healthy = True
+        self.draining = False
+        self.queue_depth = 0  # 마지막 /queue 조회 때 running + pending
+        self.inflight = 0  # 이 프로세스가 이 서버에 배정하고 아직 끝나지 않은 prompt 수
+        self.latency = None  # prompt 하나의 queue-to-done 시간 EWMA
+        self.failures = 0
+        self.last_error = None
+        self.last_checked = None
+
+    @property
+    def base_url(self) -> str:
+        return self.client.base_url
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and not self.draining
+
+    @property
+    def pending(self) -> int:
+        # /queue 값은 조회 시점 이후 우리가 올린 prompt를 모르므로 로컬 카운터와 큰 쪽을 쓴다
+        return max(self.queue_depth, self.inflight)
+
+    def expected_wait(self) -> float:
+        return (self.pending + 1) * (self.latency or DEFAULT_PROMPT_SECONDS)
+
+    def record_latency(self, seconds: float):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency = LATENCY_EWMA_ALPHA * seconds + (1 - LATENCY_EWMA_ALPHA) * self.latency
+
+    def mark_down(self, error: Exception):
+        if self.healthy:
+            logger.warning("ComfyUI backend down: %s: %r", self.base_url, error)
+        self.healthy = False
+        self.failures += 1
+        self.last_error = repr(error)
+
+    async def refresh(self):
+        try:
+            # 상태 확인은 주기적으로 다시 하므로 재시도하지 않는다
+            queue = await self.client.get_queue(retries=0)
+        except Exception as e:
+            self.mark_down(e)
+        else:
+            self.queue_depth = len(queue.get('queue_running', [])) + len(queue.get('queue_pending', []))
+            if not self.healthy:
+                logger.info("ComfyUI backend recovered: %s", self.base_url)
+            self.healthy = True
+            self.last_error = None
+        self.last_checked = time.time()
+
+    def metrics(self) -> dict:
+        return {
+            'base_url': self.base_url,
+            'healthy': self.healthy,
+            'draining': self.draining,
+            'queue_depth': self.queue_depth,
+            'inflight': self.inflight,
+            'latency': self.latency,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'pool': self.client.pool_metrics(),
+        }
+
+
+# 다른 서버에서 다시 시도할 만한 오류 (서버 다운, 연결 끊김)
+BACKEND_ERRORS = (aiohttp.ClientError, ConnectionError, asyncio.TimeoutError)
+
+
+class ComfyUIPool:
+    """
+    여러 ComfyUI 서버에 prompt를 나눠 보내는 스케줄러.
+
+    예상 대기 시간((대기열 길이 + 1) x 최근 지연 시간)이 가장 짧은 정상 서버를 고르고,
+    입력 이미지가 이미 올라가 있는 서버는 조금 더 바빠도 우선한다.
+    """
+
+    def __init__(self, urls=None, health_interval: float = COMFYUI_HEALTH_INTERVAL,
+                 affinity_slack: int = COMFYUI_AFFINITY_SLACK, clients=None, drain=COMFYUI_DRAIN):
+        clients = clients or [ComfyUIClient(url) for url in (urls or COMFYUI_URLS)]
+        self.backends = [ComfyUIBackend(client) for client in clients]
+        for base_url in drain:
+            try:
+                self.drain(base_url)
+            except KeyError:
+                logger.warning("COMFYUI_DRAIN refers to an unknown backend: %s", base_url)
+        self.health_interval = health_interval
+        self.affinity_slack = affinity_slack
+        self._health_task = None
+
+    async def start(self):
+        await asyncio.gather(*(backend.client.start() for backend in self.backends))
+        await self.refresh()
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+        await asyncio.gather(*(backend.client.close() for backend in self.backends))
+
+    async def refresh(self):
+        await asyncio.gather(*(backend.refresh() for backend in self.backends))
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.refresh()
+
+    def get(self, base_url: str) -> ComfyUIBackend:
+        for backend in self.backends:
+            if backend.base_url == base_url.rstrip('/'):
+                return backend
+        raise KeyError(base_url)
+
+    def pick(self, exclude=(), prefer=()) -> ComfyUIBackend:
+        """
+        prompt를 보낼 서버를 고른다.
+
+        exclude 는 방금 실패한 서버, prefer 는 입력 이미지가 이미 올라가 있는 서버 목록이다.
+        정상 서버가 하나도 없으면 제외되지 않은 서버 중에서 고른다(다시 살아났을 수 있으므로).
+        """
+        candidates = [b for b in self.backends if b.available and b not in exclude]
+        if not candidates:
+            candidates = [b for b in self.backends if not b.draining and b not in exclude] or list(self.backends)
+
+        best = min(candidates, key=lambda b: b.expected_wait())
+        preferred = [b for b in candidates if b in prefer]
+        if preferred:
+            pinned = min(preferred, key=lambda b: b.expected_wait())
+            if pinned.pending <= best.pending + self.affinity_slack:
+                return pinned
+        return best
+
+    @contextmanager
+    def assign(self, backend: ComfyUIBackend, count: int = 1):
+        """
+        backend에 prompt count개를 배정해 둔다. 한 페르소나의 감정들을 한 서버에 고정할 때
+        실제로 큐에 올라가기 전부터 부하로 잡혀야 동시에 들어온 다른 요청이 같은 서버로 몰리지 않는다.
+        """
+        backend.inflight += count
+        try:
+            yield backend
+        finally:
+            backend.inflight -= count
+
+    def drain(self, base_url: str, draining: bool = True):
+        """서버에 새 prompt를 보내지 않는다. 이미 올라간 prompt는 끝까지 기다린다."""
+        self.get(base_url).draining = draining
+
+    def metrics(self) -> list:
+        return [backend.metrics() for backend in self.backends]
+
+
+_pool = None
+
+
+def get_comfyui_pool() -> ComfyUIPool:
+    """프로세스가 공유하는 ComfyUI 서버 풀. FastAPI lifespan 밖에서는 처음 호출될 때 만든다."""
+    global _pool
+    if _pool is None:
+        _pool = ComfyUIPool()
+    return _pool
+
+
+async def start_comfyui_pool(pool: ComfyUIPool = None) -> ComfyUIPool:
+    global _pool
+    if pool is not None:
+        _pool = pool
+    pool = get_comfyui_pool()
+    await pool.start()
+    return pool
+
+
+async def close_comfyui_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
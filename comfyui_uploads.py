@@ -0,0 +1,202 @@
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from io import BytesIO
+
+from starlette.datastructures import UploadFile  # 엔드포인트가 받는 객체는 fastapi.UploadFile 의 부모 클래스다
+
+import singleflight
+
+logger = logging.getLogger(__name__)
+
+# ComfyUI input 폴더 아래에서 이 서비스가 올린 얼굴 이미지만 모아두는 하위 폴더
+UPLOAD_SUBFOLDER = os.getenv("COMFYUI_UPLOAD_SUBFOLDER", "mirror")
+UPLOAD_CACHE_SIZE = int(os.getenv("UPLOAD_CACHE_SIZE", "512"))
+# 마지막으로 쓴 뒤 이 시간(초)이 지나면 캐시에서 잊는다 (쓸 때마다 다시 센다)
+UPLOAD_CACHE_TTL = float(os.getenv("UPLOAD_CACHE_TTL", "3600"))
+# ComfyUI와 같은 파일시스템을 쓰는 경우에만 설정한다. 설정되어 있으면 만료된 업로드 파일을 지운다.
+COMFYUI_INPUT_DIR = os.getenv("COMFYUI_INPUT_DIR")
+
+
+class InputImage:
+    """한 번만 인코딩된 입력 얼굴 이미지와 그 내용 해시"""
+
+    def __init__(self, data: bytes, content_type: str = "image/png", extension: str = "png"):
+        self.data = data
+        self.content_type = content_type
+        self.extension = extension
+        self.digest = hashlib.sha256(data).hexdigest()
+
+    @property
+    def filename(self) -> str:
+        return f"{self.digest[:32]}.{self.extension}"
+
+
+async def to_input_image(image) -> InputImage:
+    """UploadFile / bytes / PIL Image 를 업로드용 InputImage 로 한 번만 변환한다."""
+    if isinstance(image, InputImage):
+        return image
+    if isinstance(image, UploadFile):
+        data = await image.read()
+        await image.seek(0)
+        return InputImage(data, image.content_type or "application/octet-stream", _extension(image.filename))
+    if isinstance(image, (bytes, bytearray)):
+        return InputImage(bytes(image), "application/octet-stream", "png")
+    # PIL Image
+    img_byte_arr = BytesIO()
+    image.save(img_byte_arr, format='PNG')
+    return InputImage(img_byte_arr.getvalue(), "image/png", "png")
+
+
+def _extension(filename: str) -> str:
+    ext = os.path.splitext(filename or "")[1].lstrip('.').lower()
+    return ext if ext in ('png', 'jpg', 'jpeg', 'webp') else 'png'
+
+
+class UploadCache:
+    """
+    (ComfyUI 주소, 이미지 내용 해시) -> LoadImage 노드에 넣을 파일 이름.
+
+    업로드는 ComfyUIClient 의 공유 커넥션 풀을 통해 보낸다.
+
+    같은 페르소나의 여러 감정과 같은 사용자의 재요청이 이미 올라간 파일을
+    다시 쓰도록 하고, 동시에 들어온 같은 이미지 업로드는 하나로 합친다.
+    캐시에서 잊은 파일은 hold 중이 아니고 마지막으로 쓴 뒤 delete_grace 초가 지났을 때 지운다.
+    """
+
+    def __init__(self, max_entries: int = UPLOAD_CACHE_SIZE, ttl: float = UPLOAD_CACHE_TTL,
+                 input_dir: str = COMFYUI_INPUT_DIR, subfolder: str = UPLOAD_SUBFOLDER,
+                 delete_grace: float = 0.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.input_dir = input_dir
+        self.subfolder = subfolder
+        self.delete_grace = delete_grace
+        self._entries = OrderedDict()  # key -> (image_ref, last_used_at)
+        self._inflight = {}  # key -> 진행 중인 업로드 Task
+        self._retired = {}  # 캐시에서 잊었지만 아직 지우지 않은 파일 image_ref -> last_used_at
+        self._held = {}  # image_ref -> 그 파일을 쓰는 prompt 를 기다리는 요청 수
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_upload(self, client, image: InputImage) -> str:
+        key = (client.base_url, image.digest)
+        self._evict_expired()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            # 돌려준 파일은 곧 prompt 에 쓰이므로 만료 / 삭제 시간을 지금부터 다시 센다
+            self._entries[key] = (entry[0], time.monotonic())
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        # 같은 이미지를 동시에 올리려는 감정들은 하나의 업로드 작업을 함께 기다린다
+        if key in self._inflight:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return await singleflight.run(self._inflight, key, lambda: self._upload_and_store(key, client, image))
+
+    async def _upload_and_store(self, key, client, image: InputImage) -> str:
+        image_ref = await self._upload(client, image)
+        # 같은 이름으로 다시 올렸으니 지우려고 미뤄 둔 파일이면 지우지 않는다
+        self._retired.pop(image_ref, None)
+        self._entries[key] = (image_ref, time.monotonic())
+        self._evict_overflow()
+        return image_ref
+
+    def has(self, client, image: InputImage) -> bool:
+        """이 이미지가 client 의 ComfyUI 서버에 이미 올라가 있는지 (또는 올라가는 중인지)"""
+        key = (client.base_url, image.digest)
+        return key in self._entries or key in self._inflight
+
+    @contextmanager
+    def hold(self, image_ref: str):
+        """
+        image_ref 를 읽는 prompt 를 기다리는 동안 캐시에서 잊더라도 파일을 지우지 않는다.
+        큐에서 얼마나 기다릴지 모르므로 유예 시간은 마지막 요청이 기다리기를 마친 때부터 센다.
+        """
+        self._held[image_ref] = self._held.get(image_ref, 0) + 1
+        try:
+            yield image_ref
+        finally:
+            self._held[image_ref] -= 1
+            if not self._held[image_ref]:
+                del self._held[image_ref]
+                if image_ref in self._retired:
+                    self._retired[image_ref] = time.monotonic()
+
+    def invalidate(self, client, image: InputImage):
+        self._entries.pop((client.base_url, image.digest), None)
+
+    async def _upload(self, client, image: InputImage) -> str:
+        result = await client.upload_image(image.data, image.filename, image.content_type, self.subfolder)
+        name = result.get('name', image.filename)
+        subfolder = result.get('subfolder', self.subfolder)
+        return f"{subfolder}/{name}" if subfolder else name
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [key for key, (_, last_used_at) in self._entries.items() if now - last_used_at > self.ttl]
+        for key in expired:
+            self._remove(key)
+        for image_ref, last_used_at in list(self._retired.items()):
+            if image_ref not in self._held and now - last_used_at > self.delete_grace:
+                del self._retired[image_ref]
+                self._delete_input_file(image_ref)
+
+    def _evict_overflow(self):
+        while len(self._entries) > self.max_entries:
+            key = next(iter(self._entries))
+            self._remove(key)
+
+    def _remove(self, key):
+        image_ref, last_used_at = self._entries.pop(key)
+        if image_ref not in self._held and time.monotonic() - last_used_at > self.delete_grace:
+            self._delete_input_file(image_ref)
+        else:
+            # 최근에 쓴 파일은 큐에 있는 prompt 가 아직 읽을 수 있으니 유예 시간이 지난 뒤에 지운다
+            self._retired[image_ref] = last_used_at
+
+    def _delete_input_file(self, image_ref: str):
+        if not self.input_dir:
+            return
+        path = os.path.join(self.input_dir, *image_ref.split('/'))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Failed to remove ComfyUI input file %s: %s", path, e)
+
+    def cleanup_input_dir(self) -> int:
+        """
+        ComfyUI input/<subfolder> 에서 캐시에 없고 TTL 보다 오래된 파일을 지운다.
+        프로세스 재시작 등으로 캐시가 잊어버린 파일을 정리할 때 쓴다.
+        """
+        if not self.input_dir or not self.subfolder:
+            return 0
+        folder = os.path.join(self.input_dir, self.subfolder)
+        if not os.path.isdir(folder):
+            return 0
+
+        self._evict_expired()
+        live = {image_ref for image_ref, _ in self._entries.values()} | set(self._retired) | set(self._held)
+        cutoff = time.time() - max(self.ttl, self.delete_grace)
+        removed = 0
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if f"{self.subfolder}/{name}" in live:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError as e:
+                logger.warning("Failed to remove ComfyUI input file %s: %s", path, e)
+        return removed
+
@@ -0,0 +1,181 @@
+import asyncio
+import json
+import logging
+import uuid
+from collections import OrderedDict
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class ComfyUIProgressListener:
+    """
+    ComfyUI `/ws?clientId=...` 웹소켓 하나를 프로세스 전체가 공유하면서
+    executing / executed / progress 이벤트를 prompt_id 별 future로 전달한다.
+
+    ComfyUI는 prompt를 큐에 올린 client_id의 소켓으로만 실행 이벤트를 보내므로
+    queue_prompt 호출 시 반드시 이 리스너의 client_id를 함께 보내야 한다.
+    소켓이 끊기면 대기 중인 future에 ConnectionError를 넘겨서 호출자가
+    /history 폴링으로 넘어가게 한다.
+    """
+
+    def __init__(self, client, client_id: str = None, reconnect_delay: float = 1.0, max_reconnect_delay: float = 30.0):
+        self.client = client
+        self.client_id = client_id or uuid.uuid4().hex
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self._task = None
+        self._connected = asyncio.Event()
+        self._waiters = {}  # prompt_id -> [(future, output_node)]
+        self._outputs = {}  # prompt_id -> {node_id: output}
+        self._completed = OrderedDict()  # 등록 전에 끝난 prompt의 결과
+        self._completed_limit = 256
+        self._subscribers = {}  # prompt_id -> [callback(msg_type, data)]
+        self._current = None  # 지금 실행 중인 prompt_id (prompt_id 없는 progress 이벤트용)
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    async def start(self, connect_timeout: float = 5.0):
+        if self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout=connect_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("ComfyUI websocket 연결 대기 시간 초과: %s", self.client.base_url)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._connected.clear()
+        self._fail_waiters(ConnectionError("ComfyUI websocket listener stopped"))
+
+    async def wait_for(self, prompt_id: str, output_node: str = None, timeout: float = None):
+        """
+        prompt_id의 실행 결과를 history 항목과 같은 모양({'outputs': {...}})으로 반환한다.
+
+        output_node가 주어지면 그 노드가 실행을 마치는 즉시 깨어나고,
+        없으면 prompt 전체가 끝날 때 깨어난다. 시간 초과 시 None을 반환한다.
+        """
+        if prompt_id in self._completed:
+            return self._completed[prompt_id]
+        if output_node is not None and output_node in self._outputs.get(prompt_id, {}):
+            return {'outputs': dict(self._outputs[prompt_id])}
+        if not self.connected:
+            raise ConnectionError("ComfyUI websocket is not connected")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(prompt_id, []).append((future, output_node))
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._waiters.get(prompt_id)
+            if waiters is not None:
+                waiters[:] = [w for w in waiters if w[0] is not future]
+                if not waiters:
+                    del self._waiters[prompt_id]
+
+    def subscribe(self, prompt_id: str, callback):
+        """prompt_id 의 모든 실행 이벤트를 callback(msg_type, data)로 받는다. callback 은 동기 함수여야 한다."""
+        self._subscribers.setdefault(prompt_id, []).append(callback)
+
+    def unsubscribe(self, prompt_id: str, callback):
+        callbacks = self._subscribers.get(prompt_id)
+        if callbacks is None:
+            return
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            del self._subscribers[prompt_id]
+
+    async def _run(self):
+        delay = self.reconnect_delay
+        url = f"{self.client.base_url}/ws?clientId={self.client_id}"
+        while True:
+            try:
+                # 웹소켓도 클라이언트의 커넥션 풀 세션을 같이 쓴다
+                async with self.client.session.ws_connect(url, heartbeat=30) as ws:
+                    self._connected.set()
+                    delay = self.reconnect_delay
+                    logger.info("ComfyUI websocket 연결됨: %s", url)
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self._dispatch(json.loads(msg.data))
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            break
+                        # BINARY 메시지는 미리보기 이미지라서 무시한다
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("ComfyUI websocket 오류: %s", e)
+
+            self._connected.clear()
+            # 끊긴 동안의 이벤트는 받을 수 없으므로 대기 중인 호출자는 /history로 넘어간다
+            self._fail_waiters(ConnectionError("ComfyUI websocket disconnected"))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _dispatch(self, message: dict):
+        msg_type = message.get('type')
+        data = message.get('data') or {}
+        if msg_type == 'execution_start':
+            self._current = data.get('prompt_id')
+        # 오래된 ComfyUI 는 progress 이벤트에 prompt_id 를 넣지 않는다
+        prompt_id = data.get('prompt_id') or (self._current if msg_type == 'progress' else None)
+        if prompt_id is None:
+            return
+
+        for callback in list(self._subscribers.get(prompt_id, ())):
+            try:
+                callback(msg_type, data)
+            except Exception as e:
+                logger.warning("ComfyUI event subscriber failed for %s: %s", prompt_id, e)
+
+        if msg_type == 'executed':
+            node = str(data.get('node'))
+            self._outputs.setdefault(prompt_id, {})[node] = data.get('output')
+            for future, output_node in self._waiters.get(prompt_id, []):
+                if output_node == node and not future.done():
+                    future.set_result({'outputs': dict(self._outputs[prompt_id])})
+        elif msg_type == 'execution_success' or (msg_type == 'executing' and data.get('node') is None):
+            # 새 ComfyUI 는 execution_success 다음에 executing(None) 도 보낸다. 두 번째 것이 빈 outputs 로
+            # 결과를 덮어쓰지 않도록 prompt 마다 한 번만 끝낸다.
+            if prompt_id in self._completed:
+                return
+            self._finish(prompt_id, {'outputs': self._outputs.pop(prompt_id, {})})
+        elif msg_type in ('execution_error', 'execution_interrupted'):
+            self._outputs.pop(prompt_id, None)
+            message = data.get('exception_message') or msg_type
+            self._finish(prompt_id, RuntimeError(f"ComfyUI {msg_type} for {prompt_id}: {message}"))
+
+    def _finish(self, prompt_id: str, result):
+        if not isinstance(result, Exception):
+            self._completed[prompt_id] = result
+            while len(self._completed) > self._completed_limit:
+                self._completed.popitem(last=False)
+        for future, _ in self._waiters.pop(prompt_id, []):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _fail_waiters(self, error: Exception):
+        waiters, self._waiters = self._waiters, {}
+        for entries in waiters.values():
+            for future, _ in entries:
+                if not future.done():
+                    future.set_exception(error)
+
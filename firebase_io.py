@@ -0,0 +1,48 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import span
+
+# firebase_admin 의 Storage / Firestore 클라이언트는 동기 네트워크 호출이라서
+# 이벤트 루프를 막지 않도록 크기가 정해진 스레드 풀에서 실행한다.
+FIREBASE_IO_WORKERS = int(os.getenv("FIREBASE_IO_WORKERS", "16"))
+
+_executor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=FIREBASE_IO_WORKERS, thread_name_prefix="firebase-io")
+    return _executor
+
+
+async def run_firebase(func, *args, **kwargs):
+    """동기 Firebase 호출 func(*args, **kwargs)를 전용 스레드 풀에서 실행하고 결과를 기다린다."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def get_document(doc_ref) -> dict:
+    with span('firestore_read'):
+        snapshot = await run_firebase(doc_ref.get)
+    return snapshot.to_dict()
+
+
+async def set_document(doc_ref, data: dict, merge: bool = False):
+    with span('firestore_write'):
+        return await run_firebase(doc_ref.set, data, merge=merge)
+
+
+async def update_document(doc_ref, data: dict):
+    with span('firestore_write'):
+        return await run_firebase(doc_ref.update, data)
+
+
+def shutdown_firebase_io(wait: bool = True):
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
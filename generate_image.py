@@ -1,351 +1,615 @@
-from image_prompt import prompt
-import json
+from image_prompt import DEFAULT_EMOTIONS, PERSONA_EMOTIONS, prompt
+import logging
 import os
-import aiohttp
-import uuid
 from firebase_admin import storage
 from fastapi import HTTPException, File, UploadFile
 import asyncio
-import copy
 import random
-from PIL import Image
+import time
+from contextlib import contextmanager
 from io import BytesIO
+from comfyui_pool import BACKEND_ERRORS, get_comfyui_pool
+from comfyui_uploads import UploadCache, to_input_image
+from firebase_io import run_firebase
+from image_preprocess import prepare_input_image
+from image_variants import CONTENT_TYPES, make_variants
+from metrics import EMOTION_RESULTS, PROMPTS_CANCELLED, SampleFilter, observe_stage, span, tagged
+from persona_store import persona_store
+from result_cache import result_cache, result_key
+from workflow_templates import NEGATIVE_PROMPT, workflow_registry
+
+logger = logging.getLogger(__name__)
+# 감정마다 여러 줄씩 찍히는 진행 로그는 LOG_SAMPLE_RATE 비율만 남긴다
+logger.addFilter(SampleFilter())
+
+# 결과 이미지를 저장하는 SaveImage 노드
+OUTPUT_NODE_ID = "39"
+# Firebase Storage 재개 가능(resumable) 업로드의 청크 크기. 256KB의 배수여야 한다.
+STORAGE_CHUNK_SIZE = int(os.getenv("STORAGE_CHUNK_SIZE", str(1024 * 1024)))
+
+# 한 페르소나 요청에서 동시에 ComfyUI에 올릴 수 있는 감정 프롬프트 수
+EMOTION_CONCURRENCY = int(os.getenv("EMOTION_CONCURRENCY", "5"))
+# 실행을 시작한 prompt 의 결과를 기다리는 최대 시간(초). 큐에서 기다린 시간은 세지 않는다.
+# 기본값은 감정들을 합친 prompt 도 끝낼 수 있도록 프롬프트 하나당 1분씩 동시 실행 수만큼이다.
+PROGRESS_MAX_RETRIES = int(os.getenv("PROGRESS_MAX_RETRIES", str(60 * EMOTION_CONCURRENCY)))
+# 큐에서 기다리는 prompt 가 아직 ComfyUI 큐에 남아 있는지 확인하는 간격(초)
+PROGRESS_CHECK_INTERVAL = float(os.getenv("PROGRESS_CHECK_INTERVAL", "10"))
+# 캐시에서 잊은 입력 파일을 마지막으로 쓴 뒤 지우기까지의 시간(초). 기다리는 동안은 파일을 hold 하고,
+# 기다리기를 마친 뒤에도 취소하지 못한 prompt 가 실행될 수 있으므로 실행 시간 제한만큼 더 남겨 둔다.
+UPLOAD_DELETE_GRACE = float(os.getenv("UPLOAD_DELETE_GRACE", str(PROGRESS_MAX_RETRIES + 60)))
+
+# 페르소나 생성에 쓰는 워크플로 템플릿 (workflow_templates.py 에 등록된 이름)
+PERSONA_WORKFLOW = os.getenv("PERSONA_WORKFLOW", "persona")
+# 1이면 한 페르소나의 감정들을 공통 노드를 한 번만 가진 prompt 하나로 합쳐서 보낸다
+MERGE_EMOTION_PROMPTS = os.getenv("MERGE_EMOTION_PROMPTS", "0") == "1"
+# 다시 만들기 요청 하나가 한 번의 batch 로 만들 수 있는 최대 후보 수
+REGENERATE_MAX_CANDIDATES = int(os.getenv("REGENERATE_MAX_CANDIDATES", "4"))
+
+# users/{uid}.persona 배열에서 감정별 항목의 위치와 고정 이름
+PERSONA_LABELS = {
+    'custom': (0, {}),
+    'clone': (1, {}),
+    'joy': (2, {'Name': 'Joy', 'DPNAME': "기쁨이"}),
+    'anger': (3, {'Name': 'Anger', 'DPNAME': '화남이'}),
+    'sadness': (4, {'Name': 'Sadness', 'DPNAME': "슬픔이"}),
+}
+
+# 프로세스가 공유하는 입력 이미지 업로드 캐시
+upload_cache = UploadCache(delete_grace=UPLOAD_DELETE_GRACE)
+
+async def generate_emotion_images(emotions, make_emotion, max_concurrency: int = None, on_result=None):
+    """
+    감정별 이미지 생성을 한 번에 ComfyUI 큐에 올리고 끝나는 대로 결과를 모은다.
+
+    make_emotion(emotion)은 감정 하나를 생성하는 코루틴을 반환해야 한다.
+    한 감정이 실패해도 다른 감정은 취소되지 않고, 실패한 감정은
+    {'status': 'error', 'message': ...} 형태로 결과에 들어간다.
+    on_result(emotion, result)가 주어지면 감정 하나가 끝날 때마다 바로 불린다.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency or EMOTION_CONCURRENCY)
+
+    async def run(emotion):
+        async with semaphore:
+            try:
+                result = await make_emotion(emotion)
+                logger.info("Generated image for %s: %s", emotion, result.get('status'))
+            except Exception as e:
+                logger.warning("Error generating image for %s: %s", emotion, e)
+                result = {'status': 'error', 'message': str(e)}
+        EMOTION_RESULTS.inc(status=result.get('status', 'unknown'))
+        if on_result is not None:
+            try:
+                await on_result(emotion, result)
+            except Exception as e:
+                logger.warning("on_result callback failed for %s: %s", emotion, e)
+        return result
 
-COMFUI_OUTPUT_DIR = r"C:\Users\201-29\Downloads\StabilityMatrix-win-x64\Data\Packages\ComfyUI\output"
-COMFYUI_URL = "http://127.0.0.1:8188"
+    results = await asyncio.gather(*(run(emotion) for emotion in emotions))
+    return dict(zip(emotions, results))
 
-async def load_workflow(workflow_path):
+@contextmanager
+def internal_errors(name: str):
+    """예상하지 못한 오류를 500 으로 바꾼다. 잘못된 입력(413 / 400)이나 일시적인 거절(503)은 상태 코드를 그대로 둔다."""
     try:
-        with open(workflow_path, 'r', encoding='utf-8') as file:
-            workflow = json.load(file)
-            return workflow
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="Workflow not found")
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid workflow format")
+        yield
+    except HTTPException:
+        raise
     except Exception as e:
+        logger.error("Error in %s: %s", name, e)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
-async def generate_persona_image(uid: str, image: UploadFile = File(...)):
-    print("Persona image generation service started")
-
+async def _generate_for_persona(emotions, make_params, image, on_event=None, on_result=None, max_concurrency: int = None,
+                                template=None) -> dict:
+    """
+    페르소나 한 명의 감정들을 생성해서 {감정: 결과}를 반환한다.
+
+    make_params(emotion)은 감정 하나의 템플릿 params를 반환한다. 모든 감정이 같은 업로드를 쓰도록
+    입력 이미지는 워크플로 해상도에 맞춰 한 번만 전처리하고, 감정들은 같은 서버에 배정한다.
+    on_event 는 감정 이름이 붙은 진행 이벤트를, on_result(emotion, result)는 감정 하나가 끝날 때마다 결과를 받는다.
+    """
+    template = template or workflow_registry.get(PERSONA_WORKFLOW)
+    image = await prepare_input_image(image, template.input_size)
+    backend = pick_backend(image)
+
+    with get_comfyui_pool().assign(backend, len(emotions)):
+        if MERGE_EMOTION_PROMPTS:
+            return await generate_emotions_merged(template, emotions, make_params, image, backend, on_event, on_result)
+
+        def make_emotion(emotion):
+            logger.info("Starting image generation for %s", emotion)
+            emit = None
+            if on_event is not None:
+                # 진행 상황 이벤트에 어느 감정의 것인지 붙여서 넘긴다
+                emit = lambda event: on_event({'emotion': emotion, **event})
+            return generate_emotion(template, make_params(emotion), image, emotion, backend, emit)
+
+        return await generate_emotion_images(emotions, make_emotion, max_concurrency, on_result)
+
+async def generate_persona_image(uid: str, image: UploadFile = File(...), max_concurrency: int = None):
+    logger.info("Persona image generation service started")
+    with internal_errors('generate_persona_image'):
+        emotion_images = await _generate_for_persona(
+            DEFAULT_EMOTIONS, lambda emotion: character_params(prompt[emotion]), image, max_concurrency=max_concurrency,
+        )
+    return {"status": "complete", "images": emotion_images}
+
+def pick_backend(image=None, exclude=()):
+    """
+    prompt를 보낼 ComfyUI 서버를 고른다. 입력 이미지가 이미 올라가 있는 서버를 우선한다.
+    """
+    pool = get_comfyui_pool()
+    prefer = [b for b in pool.backends if image is not None and upload_cache.has(b.client, image)]
+    return pool.pick(exclude=exclude, prefer=prefer)
+
+async def queue_prompt(workflow: dict, client_id: str = "", client=None, front: bool = False):
+    logger.debug("queue_prompt 서비스 실행")
+    client = client or pick_backend().client
+    # client_id를 비우면 실행 이벤트가 그 서버의 공용 웹소켓 리스너로 온다
+    return await client.queue_prompt(workflow, client_id, front)
+    
+def progress_event(msg_type: str, data: dict):
+    """ComfyUI 웹소켓 이벤트를 클라이언트에 보낼 진행 상황 이벤트로 바꾼다. 보낼 것이 없으면 None."""
+    if msg_type == 'execution_start':
+        return {'type': 'state', 'state': 'running'}
+    if msg_type == 'progress':
+        return {'type': 'progress', 'node': data.get('node'), 'value': data.get('value'), 'max': data.get('max')}
+    return None
+
+async def check_progress(prompt_id: str, output_node: str = OUTPUT_NODE_ID, client=None, on_event=None):
+    """
+    prompt_id 의 결과를 웹소켓 리스너로 (연결이 없으면 /history 폴링으로) 기다린다.
+
+    시간 제한(PROGRESS_MAX_RETRIES)은 prompt 가 실행을 시작한 때부터 센다. 큐에서 기다리는 동안은
+    PROGRESS_CHECK_INTERVAL 마다 prompt 가 아직 ComfyUI 큐에 있는지만 확인해서, 앞의 작업이 밀려 있을 뿐인
+    prompt 는 계속 기다리고 결과 없이 큐에서 사라진 prompt 만 포기한다. 포기하면 None 을 반환한다.
+    """
+    logger.debug("Checking progress for prompt_id: %s", prompt_id)
+    client = client or get_comfyui_pool().backends[0].client
+    listener = await client.get_listener()
+    running_at = None
+
+    def forward(msg_type, data):
+        nonlocal running_at
+        if msg_type == 'execution_start' and running_at is None:
+            running_at = time.monotonic()
+        if on_event is not None:
+            event = progress_event(msg_type, data)
+            if event is not None:
+                on_event(event)
+
+    subscribed = use_listener = listener.connected
+    if subscribed:
+        listener.subscribe(prompt_id, forward)
+    checked_at = time.monotonic()
     try:
-        workflow = await load_workflow('workflow.json')
-        
-        emotions = ["joy", "sadness", "anger", "disgust", "serious"]
-        emotion_images = {}
-
-        for emotion in emotions:
-            try:
-                result = await make_character(prompt[emotion], copy.deepcopy(workflow), image, emotion)
-                emotion_images[emotion] = result
-                print(f"Generated image for {emotion}: {result}")
-            except Exception as e:
-                print(f"Error generating image for {emotion}: {str(e)}")
-                emotion_images[emotion] = {'status': 'error', 'message': str(e)}
-            
-            # 각 요청 사이에 잠시 대기
-            await asyncio.sleep(2)
-        
-        return {"status": "complete", "images": emotion_images}
+        while True:
+            if use_listener:
+                try:
+                    result = await listener.wait_for(prompt_id, output_node, timeout=PROGRESS_CHECK_INTERVAL)
+                except ConnectionError as e:
+                    logger.warning("Websocket unavailable for %s, falling back to /history: %s", prompt_id, e)
+                    use_listener = False
+                    continue
+                if result is not None:
+                    if output_node is None or output_node in result.get('outputs', {}):
+                        return result
+                    # 캐시된 노드는 executed 이벤트가 오지 않으므로 history에서 결과를 읽는다
+                    use_listener = False
+                    continue
+            else:
+                history = await client.get_history(prompt_id)
+                if prompt_id in history:
+                    return history_result(prompt_id, history[prompt_id])
+                await asyncio.sleep(1)  # 1초 대기
+
+            now = time.monotonic()
+            if running_at is None and now - checked_at >= PROGRESS_CHECK_INTERVAL:
+                checked_at = now
+                state = await client.prompt_state(prompt_id)
+                if state == 'running':
+                    # 구독하기 전에 실행이 시작되었거나 웹소켓 없이 기다리는 경우
+                    running_at = now
+                elif state is None:
+                    history = await client.get_history(prompt_id)
+                    if prompt_id in history:
+                        return history_result(prompt_id, history[prompt_id])
+                    logger.warning("Prompt %s left the ComfyUI queue without a result", prompt_id)
+                    return None
+            if running_at is not None and now - running_at > PROGRESS_MAX_RETRIES:
+                logger.warning("Timed out waiting for prompt_id: %s", prompt_id)
+                return None
+    finally:
+        if subscribed:
+            listener.unsubscribe(prompt_id, forward)
+
+
+def history_result(prompt_id: str, entry: dict) -> dict:
+    """/history 항목을 반환한다. 실패한 prompt 는 웹소켓 리스너와 같은 RuntimeError 로 알린다."""
+    status = entry.get('status') or {}
+    if status.get('status_str') != 'error':
+        return entry
+    msg_type, message = 'execution_error', None
+    for name, data in status.get('messages', []):
+        if name in ('execution_error', 'execution_interrupted'):
+            msg_type, message = name, (data or {}).get('exception_message')
+    raise RuntimeError(f"ComfyUI {msg_type} for {prompt_id}: {message or msg_type}")
+
+
+# 취소된 요청의 prompt 를 ComfyUI 에서 지우는 태스크 (요청 태스크가 이미 취소되어 별도로 돌린다)
+_cancel_tasks = set()
+
+
+async def cancel_prompt(client, prompt_id: str, reason: str):
+    """결과를 받을 곳이 없어진 prompt 를 ComfyUI 큐에서 지우거나 중단시켜 GPU 시간을 돌려받는다."""
+    try:
+        action = await client.cancel_prompt(prompt_id)
     except Exception as e:
-        print(f"Error in generate_persona_image: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
-
-async def queue_prompt(workflow: dict, client_id: str = ""):
-    print("queue_prompt 서비스 실행")
-    prompt_url = f"{COMFYUI_URL}/prompt"
+        logger.warning("Failed to cancel prompt %s on %s: %s", prompt_id, client.base_url, e)
+        return
+    PROMPTS_CANCELLED.inc(reason=reason, action=action)
+    logger.info("Cancelled prompt %s on %s (%s, %s)", prompt_id, client.base_url, reason, action)
 
-    payload = {
-        "prompt": workflow,
-        "client_id": client_id
-    }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(prompt_url, json=payload) as response:
-            if response.status != 200:
-                raise HTTPException(status_code=response.status, detail=f"Error queueing prompt: {await response.text()}")
-            result = await response.json()
-            return result.get("prompt_id")
-    
-async def check_progress(prompt_id: str):
-    print(f"Checking progress for prompt_id: {prompt_id}")
-    history_url = f"{COMFYUI_URL}/history/{prompt_id}"
-    max_retries = 60  # 최대 60번 시도 (1분)
-    retry_count = 0
-    async with aiohttp.ClientSession() as session:
-        while retry_count < max_retries:
-            print(f"Retry count: {retry_count}")
-            async with session.get(history_url) as response:
-                if response.status == 200:
-                    history = await response.json()
-                    if prompt_id in history:
-                        return history[prompt_id]
-            await asyncio.sleep(1)  # 1초 대기
-            retry_count += 1
-    print(f"Max retries reached for prompt_id: {prompt_id}")
-    return None  # 최대 시도 횟수를 초과하면 None 반환
+def cancel_prompt_later(client, prompt_id: str, reason: str):
+    task = asyncio.create_task(cancel_prompt(client, prompt_id, reason))
+    _cancel_tasks.add(task)
+    task.add_done_callback(_cancel_tasks.discard)
 
 
-def upload_image_to_firebase(local_image_path, destination_blob_name):
+def upload_image_to_firebase(file_obj, destination_blob_name, content_type="image/png"):
     bucket = storage.bucket()
     blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(local_image_path)
+    # chunk_size를 지정하면 메모리 버퍼에서 바로 청크 단위 재개 가능 업로드를 한다
+    blob.chunk_size = STORAGE_CHUNK_SIZE
+    blob.upload_from_file(file_obj, content_type=content_type, rewind=True)
 
     blob.make_public()
     return blob.public_url
 
 
-async def make_character(prompt_text: str, workflow: dict, image, emotion: str):
-    print(f"Starting image generation for {emotion}")
-    
-    random_seed = random.randint(0, 2**32 - 1)
-    workflow["25"]["inputs"]["text"] = prompt_text
-    workflow["34"]["inputs"]["text"] = prompt_text
-    workflow["19"]["inputs"]["noise_seed"] = random_seed
-    workflow["28"]["inputs"]["noise_seed"] = random_seed
-
-    url = f"{COMFYUI_URL}/upload/image"
-    unique_filename = f"{uuid.uuid4()}.png"
-    form = aiohttp.FormData()
-
-    # 이미지 타입에 따른 처리
-    if isinstance(image, UploadFile):
-        file_content = await image.read()
-        await image.seek(0)
-        content_type = image.content_type
-    else:  # PIL Image
-        img_byte_arr = BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        file_content = img_byte_arr.getvalue()
-        content_type = "image/png"
-
-    form.add_field("image", file_content, filename=unique_filename, content_type=content_type)
-    form.add_field('overwrite', 'true')
-
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, data=form) as response:
-            if response.status == 200:
-                workflow["1"]['inputs']['image'] = unique_filename
-                prompt_id = await queue_prompt(workflow)
-                result = await check_progress(prompt_id)
-
-                if result is None:
-                    return {'status': 'error', 'message': f'Timeout while generating image for {emotion}'}
-
-                if 'outputs' in result and '39' in result['outputs']:
-                    final_image_url = result['outputs']['39']['images'][0]['filename']
-                else:
-                    print(f"Unexpected result structure for {emotion}: {result}")
-                    return {'status': 'error', 'message': f'Unexpected result structure for {emotion}'}
-
-    if final_image_url:
-        local_image_path = os.path.join(COMFUI_OUTPUT_DIR, final_image_url)
-        destination_blob_name = f"generate_images/{emotion}_{final_image_url}"
-        firebase_url = upload_image_to_firebase(local_image_path, destination_blob_name)
-        return {'status': 'complete', 'image_url': firebase_url}
-    else:
-        return {'status': 'error', 'message': f'Failed to generate image for {emotion}'}
-        
-async def regenerate_image(emotion: str, image: UploadFile = File(...)):
-    print(f"Regenerating image for {emotion}")
-
+async def store_output_image(output_image: dict, emotion: str, client):
+    """
+    ComfyUI /view 에서 결과 이미지를 받아 로컬 디스크를 거치지 않고 Firebase Storage에 올린다.
+    원본 PNG와 함께 크기별 WebP 등의 변형(image_variants.py)을 만들어 동시에 올리고
+    (원본 URL, {변형 이름: {형식: URL}})을 반환한다.
+    """
+    buffer = BytesIO()
+    with span('output_fetch', backend=client.base_url):
+        await client.fetch_output(output_image, buffer)
+    destination_blob_name = f"generate_images/{emotion}_{output_image['filename']}"
+    # 업로드와 make_public 은 동기 호출이라 스레드 풀에서 실행한다. 감정별로 동시에 올라간다.
+    original = asyncio.create_task(upload_to_storage(buffer, destination_blob_name))
     try:
-        workflow = await load_workflow('workflow.json')
+        variant_urls = await store_output_variants(buffer.getvalue(), destination_blob_name)
+    except BaseException:
+        # 결과를 받을 요청이 취소되었으면 원본 업로드도 기다리지 않는다
+        original.cancel()
+        raise
+    url = await original
+    return url, variant_urls
 
-        result = await make_character(prompt[emotion], copy.deepcopy(workflow), image, emotion)
-        return result
-    except Exception as e:
-        print(f"Error in regenerate_image: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
-    
-async def generate_image_websocket(uid: str, image_data : bytes):
-    print("generate_image_websocket 호출")
-    print(uid)
-    print(image_data)
-    print("===============================")   
-    try:
-        workflow = await load_workflow('workflow.json')
-        
-        emotions = ["joy", "sadness", "anger", "disgust", "serious"]
-        emotion_images = {}
-
-        for emotion in emotions:
-            try:
-                result = await make_character_websocket(prompt[emotion], copy.deepcopy(workflow), image_data, emotion)
-                emotion_images[emotion] = result
-                print(f"Generated image for {emotion}: {result}")
-            except Exception as e:
-                print(f"Error generating image for {emotion}: {str(e)}")
-                emotion_images[emotion] = {'status': 'error', 'message': str(e)}
-            
-            # 각 요청 사이에 잠시 대기
-            await asyncio.sleep(2)
-        
-        return {"status": "complete", "images": emotion_images}
-    except Exception as e:
-        print(f"Error in generate_persona_image: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
-
-async def make_character_websocket(prompt_text: str, workflow: dict, image: Image.Image, emotion: str):
-    print(f"Starting image generation for {emotion}")
-    
-    # PIL 이미지 객체를 바이트로 변환
-    img_byte_arr = BytesIO()
-    image.save(img_byte_arr, format='PNG')
-    image_data = img_byte_arr.getvalue()
-    
-    # 랜덤 시드 생성
-    random_seed = random.randint(0, 2**32 - 1)
-    
-    # 25,34 positive prompt
-    workflow["25"]["inputs"]["text"] = prompt_text
-    workflow["34"]["inputs"]["text"] = prompt_text
-
-    # 7,24 negative prompt (기존과 동일)
-    workflow["7"]["inputs"]["text"] = "cross-eyed, unnatural eye alignment, distorted gaze direction, mismatched eye position, asymmetrical eyes, exaggerated reflections in eyes, blurred lips, smudged lips, distorted mouth, missing teeth, uneven teeth, broken teeth, overly sharp or exaggerated teeth, unnatural skin texture, unrealistic facial symmetry, artifacts, low quality, deformed face features, blurry details"
-    workflow["24"]["inputs"]["text"] = "cross-eyed, unnatural eye alignment, distorted gaze direction, mismatched eye position, asymmetrical eyes, exaggerated reflections in eyes, blurred lips, smudged lips, distorted mouth, missing teeth, uneven teeth, broken teeth, overly sharp or exaggerated teeth, unnatural skin texture, unrealistic facial symmetry, artifacts, low quality, deformed face features, blurry details"
-
-    # 랜덤 시드 적용 (19번과 28번 노드에 동일한 시드 적용)
-    workflow["19"]["inputs"]["noise_seed"] = random_seed
-    workflow["28"]["inputs"]["noise_seed"] = random_seed
-
-    url = f"{COMFYUI_URL}/upload/image"
-
-    # 고유한 파일 이름 생성
-    unique_filename = f"{uuid.uuid4()}.png"
-
-    form = aiohttp.FormData()
-    form.add_field("image", image_data, filename=unique_filename, content_type="image/png")
-    form.add_field('overwrite', 'true')
-
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, data=form) as response:
-            if response.status == 200:
-                workflow["1"]['inputs']['image'] = unique_filename
-                prompt_id = await queue_prompt(workflow)
-                result = await check_progress(prompt_id)
-
-                if result is None:
-                    return {'status': 'error', 'message': f'Timeout while generating image for {emotion}'}
-
-                if 'outputs' in result and '39' in result['outputs']:
-                    final_image_url = result['outputs']['39']['images'][0]['filename']
-                else:
-                    print(f"Unexpected result structure for {emotion}: {result}")
-                    return {'status': 'error', 'message': f'Unexpected result structure for {emotion}'}
-
-    if final_image_url:
-        local_image_path = os.path.join(COMFUI_OUTPUT_DIR, final_image_url)
-        destination_blob_name = f"generate_images/{emotion}_{final_image_url}"
-        firebase_url = upload_image_to_firebase(local_image_path, destination_blob_name)
-        return {'status': 'complete', 'image_url': firebase_url}
-    else:
-        return {'status': 'error', 'message': f'Failed to generate image for {emotion}'}
 
+async def upload_to_storage(file_obj, destination_blob_name, content_type="image/png"):
+    with span('storage_upload'):
+        return await run_firebase(upload_image_to_firebase, file_obj, destination_blob_name, content_type)
 
 
-async def generate_v2_persona_image(uid, final_image, customPersona, prompt, db):
-    print("generate_v2_persona_image 호출")
-    print(uid)
-    print(final_image)
-    print(customPersona)
-    print(prompt)
-
+async def store_output_variants(data: bytes, blob_name: str) -> dict:
     try:
-        workflow = await load_workflow('workflow.json')
-        
-        # emotions = ["joy", "sadness", "anger", "custom", "clone"]
-        emotions = ["custom", "clone" , "joy" , "anger" , "sadness"]
-        emotion_images = {}
-
-        user_ref = db.collection('users').document(uid)
-
-        
+        with span('variants'):
+            variants = await make_variants(data)
+    except Exception as e:
+        # 변형을 못 만들어도 원본 이미지는 쓸 수 있으므로 결과를 실패로 만들지 않는다
+        logger.warning("Failed to build output variants for %s: %s", blob_name, e)
+        return {}
+
+    stem = os.path.splitext(blob_name)[0]
+    uploads = [
+        (name, fmt, upload_to_storage(BytesIO(encoded), f"{stem}_{name}.{fmt}", CONTENT_TYPES[fmt]))
+        for name, formats in variants.items()
+        for fmt, encoded in formats.items()
+    ]
+    urls = await asyncio.gather(*(upload for _, _, upload in uploads))
+    variant_urls = {}
+    for (name, fmt, _), url in zip(uploads, urls):
+        variant_urls.setdefault(name, {})[fmt] = url
+    return variant_urls
+
+
+async def run_on_backend(backend, render, image, output_node=OUTPUT_NODE_ID, on_event=None, units: int = 1, front: bool = False,
+                         record: bool = True):
+    """
+    입력 얼굴 이미지를 (캐시를 거쳐) backend에 올리고 render(업로드된 파일 이름)가 만든 prompt를 실행한 뒤 결과를 기다린다.
+    output_node 가 None 이면 prompt 전체가 끝날 때까지 기다린다.
+    on_event 가 주어지면 queued / running / progress 이벤트를 넘긴다.
+    units 는 이 prompt가 감정 몇 개를 한꺼번에 만드는지로, 지연 시간을 감정 하나 기준으로 기록할 때 쓴다.
+    front 면 ComfyUI 큐의 맨 앞에 넣는다 (사용자가 기다리는 단건 다시 만들기 등).
+    record 가 False 면 (워밍업 등) 지연 시간을 서버의 평균과 구간 지표에 넣지 않는다.
+    """
+    client = backend.client
+    with span('input_upload', backend=client.base_url):
+        image_ref = await upload_cache.get_or_upload(client, image)
+    try:
+        prompt_id = await queue_prompt(render(image_ref), client=client, front=front)
+    except HTTPException as e:
+        if e.status_code != 400:
+            raise
+        # ComfyUI 재시작 등으로 캐시된 업로드 파일이 사라졌을 수 있으니 한 번 다시 올린다
+        upload_cache.invalidate(client, image)
+        image_ref = await upload_cache.get_or_upload(client, image)
+        prompt_id = await queue_prompt(render(image_ref), client=client, front=front)
+
+    running_at = None
+
+    def track(event):
+        # 실행 시작 이벤트로 큐 대기 시간과 샘플링 시간을 나눈다
+        nonlocal running_at
+        if running_at is None and event.get('state') == 'running':
+            running_at = time.monotonic()
+        if on_event is not None:
+            on_event(event)
+
+    track({'type': 'state', 'state': 'queued'})
+    started = time.monotonic()
+    try:
+        # 큐에서 기다리는 동안 입력 파일이 지워져 LoadImage 가 실패하지 않게 한다
+        with upload_cache.hold(image_ref), span('comfyui', backend=client.base_url):
+            result = await check_progress(prompt_id, output_node, client=client, on_event=track)
+    except asyncio.CancelledError:
+        # 요청이 취소되었으면(클라이언트 연결 끊김 등) 남은 작업이 GPU를 쓰지 않게 한다
+        cancel_prompt_later(client, prompt_id, 'cancelled')
+        raise
+    finished = time.monotonic()
+    if result is None:
+        # 멈춘 prompt 가 나중에 다시 GPU 를 쓰지 않게 한다
+        await cancel_prompt(client, prompt_id, 'timeout')
+    if not record:
+        return result
+    if running_at is not None:
+        observe_stage('queue_wait', running_at - started, backend=client.base_url)
+        observe_stage('sampling', finished - running_at, backend=client.base_url)
+    if result is not None:
+        backend.record_latency((finished - started) / units)
+    return result
+
+
+async def queue_with_input_image(render, image, backend=None, on_event=None, output_node=OUTPUT_NODE_ID, units: int = 1,
+                                 front: bool = False):
+    """
+    backend(없으면 스케줄러가 고른 서버)에서 render로 만든 prompt를 실행하고 (결과, 실제로 실행한 서버)를 반환한다.
+    서버가 죽었으면 그 서버를 내려두고 다른 서버에서 다시 시도한다.
+    """
+    pool = get_comfyui_pool()
+    image = await to_input_image(image)
+    # 호출자가 고정한 서버는 호출자가 배정해 두었고, 그 밖의 서버는 여기서 한 건씩 배정한다
+    assigned = backend is None
+    backend = backend or pick_backend(image)
+    tried = []
+    while True:
+        try:
+            if assigned:
+                with pool.assign(backend, units):
+                    return await run_on_backend(backend, render, image, output_node, on_event, units, front), backend
+            return await run_on_backend(backend, render, image, output_node, on_event, units, front), backend
+        except BACKEND_ERRORS as e:
+            backend.mark_down(e)
+            tried.append(backend)
+            if len(tried) >= len(pool.backends):
+                raise
+            backend = pick_backend(image, exclude=tried)
+            assigned = True
+            logger.warning("Retrying on ComfyUI backend %s", backend.base_url)
+
+
+async def save_result(result, template, emotion: str, client, output_node: str = None) -> dict:
+    """ComfyUI 실행 결과에서 출력 이미지를 꺼내 Storage에 올리고 감정 하나의 결과 dict를 만든다."""
+    output_node = output_node or template.output_node
+    if result is None:
+        return {'status': 'error', 'message': f'Timeout while generating image for {emotion}'}
+
+    if 'outputs' in result and output_node in result['outputs']:
+        output_image = result['outputs'][output_node]['images'][0]
+    else:
+        logger.warning("Unexpected result structure for %s: %s", emotion, result)
+        return {'status': 'error', 'message': f'Unexpected result structure for {emotion}'}
 
-        user_doc = user_ref.get().to_dict()
+    if output_image.get('filename'):
+        firebase_url, variants = await store_output_image(output_image, emotion, client)
+        return {'status': 'complete', 'image_url': firebase_url, 'variants': variants}
+    else:
+        return {'status': 'error', 'message': f'Failed to generate image for {emotion}'}
 
-        print("=================================")
 
-        user_persona = user_doc['persona']
-        
-        print(user_persona)
+async def generate_emotion(template, params: dict, image, emotion: str, backend=None, on_event=None, use_cache=True):
+    """
+    감정 하나를 생성한다. 같은 (입력 이미지, 템플릿, 프롬프트)로 이미 만든 결과가 있으면 그대로 쓰고,
+    같은 생성이 진행 중이면 그것을 함께 기다린다. use_cache=False 면 항상 새로 만든다.
+    """
+    image = await to_input_image(image)
+
+    async def generate():
+        render = lambda image_ref: template.render(image=image_ref, **params)
+        with tagged(emotion=emotion, workflow=template.name):
+            result, used = await queue_with_input_image(render, image, backend, on_event, template.output_node)
+            return await save_result(result, template, emotion, used.client)
+
+    if not use_cache:
+        return await generate()
+
+    def on_hit():
+        logger.info("Result cache hit for %s", emotion)
+        if on_event is not None:
+            on_event({'type': 'state', 'state': 'cached'})
+
+    key = result_key(image, template, params)
+    return await result_cache.get_or_generate(key, generate, on_hit)
+
+
+async def generate_emotions_merged(template, emotions, make_params, image, backend=None, on_event=None, on_result=None):
+    """
+    감정들을 prompt 하나로 합쳐 생성한다 (MERGE_EMOTION_PROMPTS).
+
+    체크포인트 / IPAdapter 로더, LoadImage, WD14 태거 같은 앞부분은 한 번만 실행되고
+    감정마다 다른 텍스트 인코더 / 샘플러 / SaveImage 만 갈라진다.
+    결과는 출력 노드 id("39_joy" 등)로 감정에 다시 나눈다. make_params(emotion)은 감정 하나의 params를 반환한다.
+    """
+    image = await to_input_image(image)
+    results = {}
+    params = {}
+    for emotion in emotions:
+        try:
+            params[emotion] = make_params(emotion)
+        except Exception as e:
+            logger.warning("Error generating image for %s: %s", emotion, e)
+            results[emotion] = {'status': 'error', 'message': str(e)}
+
+    def emit_for(names):
+        if on_event is None:
+            return None
+
+        def emit(event):
+            node = event.get('node')
+            for name in names:
+                if node is None or str(node).endswith(f"_{name}"):
+                    on_event({'emotion': name, **event})
+        return emit
+
+    async def generate_many(names):
+        branches = {name: params[name] for name in names}
+        output_nodes = {}
+
+        def render(image_ref):
+            graph, outputs = template.render_branches(branches, image=image_ref)
+            output_nodes.update(outputs)
+            return graph
+
+        try:
+            with tagged(emotion='merged', workflow=template.name):
+                result, used = await queue_with_input_image(render, image, backend, emit_for(names), None, len(names))
+        except Exception as e:
+            logger.warning("Error generating merged prompt for %s: %s", names, e)
+            return {name: {'status': 'error', 'message': str(e)} for name in names}
+
+        async def save(name):
+            with tagged(emotion=name, workflow=template.name):
+                return await save_result(result, template, name, used.client, output_nodes.get(name))
+
+        saved = await asyncio.gather(*(save(name) for name in names), return_exceptions=True)
+        return {
+            name: value if not isinstance(value, Exception) else {'status': 'error', 'message': str(value)}
+            for name, value in zip(names, saved)
+        }
+
+    def on_hit(name):
+        logger.info("Result cache hit for %s", name)
+        if on_event is not None:
+            on_event({'emotion': name, 'type': 'state', 'state': 'cached'})
+
+    keys = {emotion: result_key(image, template, params[emotion]) for emotion in params}
+    results.update(await result_cache.get_or_generate_many(keys, generate_many, on_hit))
+
+    for emotion in emotions:
+        EMOTION_RESULTS.inc(status=results[emotion].get('status', 'unknown'))
+    if on_result is not None:
         for emotion in emotions:
             try:
-                result = await make_character(prompt[emotion], copy.deepcopy(workflow), final_image, emotion)
-                emotion_images[emotion] = result
-                print(f"Generated image for {emotion}: {result}")
-
+                await on_result(emotion, results[emotion])
             except Exception as e:
-                print(f"Error generating image for {emotion}: {str(e)}")
-                emotion_images[emotion] = {'status': 'error', 'message': str(e)}
-            
-            # 각 요청 사이에 잠시 대기
-            await asyncio.sleep(2)
-        
-
-
-        print('9999')
-
-
-        while len(user_persona) < 5:
-            index = len(user_persona)
-            user_persona.append({})
-
-
-        # print(1)
-        # user_persona[0]['IMG'] = emotion_images['custom']['image_url']
-        # print(2)
-        # user_persona[1]['IMG'] = emotion_images['clone']['image_url']
-        # print(3)
-        # user_persona[2]['Name'] = "Joy"
-        # user_persona[2]['IMG'] = emotion_images['joy']['image_url']
-        # print(4)
-        # user_persona[3]['Name'] = "Anger"
-        # user_persona[3]['IMG'] = emotion_images['anger']['image_url']
-        # print(5)
-        # user_persona[4]['Name'] = "Sadness"
-        # user_persona[4]['IMG'] = emotion_images['sadness']['image_url']
-
-
-        for i, persona in enumerate(user_persona):
-            if i == 0:
-                persona['IMG'] = emotion_images['custom']['image_url']
-            elif i == 1:
-                persona['IMG'] = emotion_images['clone']['image_url']
-            elif i == 2:
-                persona['IMG'] = emotion_images['joy']['image_url']
-                persona['Name'] = 'Joy'  # 필요한 경우 이름 수정
-                persona['DPNAME'] = "기쁨이"
-            elif i == 3:
-                persona['IMG'] = emotion_images['anger']['image_url']
-                persona['Name'] = 'Anger'
-                persona['DPNAME'] = '화남이'
-            elif i == 4:
-                persona['IMG'] = emotion_images['sadness']['image_url']
-                persona['Name'] = 'Sadness'
-                persona['DPNAME'] = "슬픔이"
-
-            
-        print("Updated user_persona:", user_persona)
-
-        print('1111')
-
-        user_ref.set(
-            {"persona" : user_persona},
-            merge=True
-        )
-
-        print('1212')
-
-        return {"status": "complete", "images": emotion_images}
-    except Exception as e:
-        print(f"Error in generate_persona_image: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
-
-
-
+                logger.warning("on_result callback failed for %s: %s", emotion, e)
+    return {emotion: results[emotion] for emotion in emotions}
+
+
+def character_params(prompt_text: str, negative: str = None) -> dict:
+    params = {'positive': prompt_text, 'seed': random.randint(0, 2**32 - 1)}
+    if negative is not None:
+        params['negative'] = negative
+    return params
+
+
+async def regenerate_image(emotion: str, image: UploadFile = File(...), candidates: int = 1, priority: bool = True):
+    """
+    감정 하나를 다시 만든다. 후보 candidates 개를 batch_size 가 그만큼인 prompt 하나로 샘플링해서
+    모델 / 얼굴 임베딩 같은 앞부분을 한 번만 실행하고, 후보들을 동시에 올려 함께 돌려준다.
+    priority 면 ComfyUI 큐의 맨 앞에 넣어서 페르소나 생성 작업 뒤에서 기다리지 않게 한다.
+    """
+    logger.info("Regenerating image for %s (%d candidates)", emotion, candidates)
+    if emotion not in prompt:
+        raise HTTPException(status_code=404, detail=f"Unknown emotion: {emotion}")
+    if not 1 <= candidates <= REGENERATE_MAX_CANDIDATES:
+        raise HTTPException(status_code=400, detail=f"candidates must be between 1 and {REGENERATE_MAX_CANDIDATES}")
+
+    with internal_errors('regenerate_image'):
+        template = workflow_registry.get(PERSONA_WORKFLOW)
+        image = await prepare_input_image(image, template.input_size)
+
+        # 다시 만들기는 같은 입력이라도 새 결과를 원하는 것이므로 결과 캐시를 거치지 않는다
+        params = {**character_params(prompt[emotion]), 'batch_size': candidates}
+        render = lambda image_ref: template.render(image=image_ref, **params)
+        with tagged(emotion=emotion, workflow=template.name):
+            result, used = await queue_with_input_image(render, image, output_node=template.output_node, front=priority)
+            return await save_candidates(result, template, emotion, used.client, params['seed'])
+
+
+async def save_candidates(result, template, emotion: str, client, seed: int) -> dict:
+    """
+    batch 결과의 이미지를 모두 동시에 Storage에 올린다.
+    ComfyUI 는 batch 전체에 시드 하나를 쓰고 batch 안의 순서마다 다른 노이즈를 만들므로
+    후보마다 (seed, batch_index)를 붙여서 같은 후보를 다시 만들 수 있게 한다.
+    """
+    if result is None:
+        return {'status': 'error', 'message': f'Timeout while generating image for {emotion}'}
+    images = result.get('outputs', {}).get(template.output_node, {}).get('images', [])
+    if not images:
+        logger.warning("Unexpected result structure for %s: %s", emotion, result)
+        return {'status': 'error', 'message': f'Unexpected result structure for {emotion}'}
+
+    stored = await asyncio.gather(*(store_output_image(image, emotion, client) for image in images))
+    return {
+        'status': 'complete',
+        'emotion': emotion,
+        'candidates': [
+            {'image_url': url, 'variants': variants, 'seed': seed, 'batch_index': index}
+            for index, (url, variants) in enumerate(stored)
+        ],
+    }
     
+async def generate_image_websocket(uid: str, image_data : bytes, max_concurrency: int = None, on_event=None, on_result=None):
+    logger.info("generate_image_websocket 호출 uid=%s", uid)
+    with internal_errors('generate_image_websocket'):
+        # positive / negative 프롬프트와 랜덤 시드만 템플릿에 덮어쓴다
+        emotion_images = await _generate_for_persona(
+            DEFAULT_EMOTIONS, lambda emotion: character_params(prompt[emotion], NEGATIVE_PROMPT), image_data,
+            on_event, on_result, max_concurrency,
+        )
+    return {"status": "complete", "images": emotion_images}
+
+
+async def generate_v2_persona_image(uid, final_image, customPersona, prompt, max_concurrency: int = None, on_result=None):
+    """
+    prompt 는 이 요청의 build_persona_prompts() 결과 (custom / clone 포함).
+    사용자 문서는 다시 읽지 않고, 감정별 결과를 persona 배열 항목 패치로 persona_store 에 쓴다.
+    """
+    logger.info("generate_v2_persona_image 호출 uid=%s", uid)
+    logger.debug("customPersona=%s", customPersona)
+
+    with internal_errors('generate_v2_persona_image'):
+        emotions = PERSONA_EMOTIONS
+        emotion_images = await _generate_for_persona(
+            emotions, lambda emotion: character_params(prompt[emotion]), final_image,
+            on_result=on_result, max_concurrency=max_concurrency,
+        )
 
+        # 배열 전체를 덮어쓰지 않고 끝난 감정의 항목 필드만 바꾼다 (동시에 온 다른 쓰기를 지우지 않도록)
+        patches = {}
+        for emotion in emotions:
+            result = emotion_images.get(emotion) or {}
+            if 'image_url' not in result:
+                continue
+            index, labels = PERSONA_LABELS[emotion]
+            # 클라이언트가 화면 크기에 맞는 가장 작은 이미지를 고를 수 있도록 변형 URL도 함께 저장한다
+            patches[index] = {'IMG': result['image_url'], **labels, 'IMG_VARIANTS': result.get('variants', {})}
 
+        logger.debug("persona patches: %s", patches)
+        await persona_store.patch_persona(uid, patches)
 
+    return {"status": "complete", "images": emotion_images}
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from fastapi import HTTPException
+from starlette.datastructures import UploadFile  # 엔드포인트가 받는 객체는 fastapi.UploadFile 의 부모 클래스다
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from comfyui_uploads import InputImage
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+# 디코딩 / 리사이즈 / 인코딩은 CPU 작업이라 이벤트 루프가 아닌 별도 프로세스에서 한다
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 이보다 큰 업로드는 디코딩하지 않고 거절한다
+INPUT_MAX_BYTES = int(os.getenv("INPUT_MAX_BYTES", str(20 * 1024 * 1024)))
+# 압축 폭탄 방지용 최대 픽셀 수 (기본 50MP)
+INPUT_MAX_PIXELS = int(os.getenv("INPUT_MAX_PIXELS", str(50_000_000)))
+# ComfyUI에 올릴 형식. jpeg 가 png 보다 인코딩이 훨씬 빠르고 작다.
+INPUT_FORMAT = os.getenv("INPUT_FORMAT", "jpeg").lower()
+INPUT_JPEG_QUALITY = int(os.getenv("INPUT_JPEG_QUALITY", "95"))
+
+FORMATS = {
+    'jpeg': ("image/jpeg", "jpg"),
+    'png': ("image/png", "png"),
+    'webp': ("image/webp", "webp"),
+}
+
+_executor = None
+# 기본 아바타처럼 파일 경로로 들어오는 이미지는 (경로, 수정 시각, 크기)별로 결과를 기억한다
+_path_cache = {}
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # forkserver 로 띄운 워커는 서버 프로세스의 소켓을 물려받지 않으므로, 요청을 받는 중에
+        # 풀을 다시 만들어도 웹소켓 연결 종료가 막히지 않는다
+        _executor = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS,
+                                        mp_context=multiprocessing.get_context('forkserver'))
+    return _executor
+
+
+async def run_in_pool(func, *args):
+    """
+    func(*args)를 전처리 프로세스 풀에서 실행한다. 워커가 죽어 풀이 깨졌으면(BrokenProcessPool)
+    다음 요청부터 쓸 새 풀을 만들고 이번 요청은 503 으로 돌려보낸다.
+    """
+    global _executor
+    executor = get_executor()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    except BrokenProcessPool as e:
+        logger.error("Image process pool is broken, recreating it: %s", e)
+        if _executor is executor:
+            _executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise HTTPException(status_code=503, detail="Image processing is temporarily unavailable")
+
+
+async def start_preprocess() -> ProcessPoolExecutor:
+    """
+    워커 프로세스를 지금 띄운다. fork 는 처음 submit 할 때 일어나는데, 요청을 받기 시작한 뒤에 fork 되면
+    그때 열려 있던 클라이언트 소켓이 워커에 복사되어 웹소켓 연결 종료가 서버에 전달되지 않는다.
+    (워커는 forkserver 로 띄우지만 첫 요청이 워커 시작 시간을 기다리지 않도록 미리 띄운다.)
+    """
+    executor = get_executor()
+    await asyncio.get_running_loop().run_in_executor(executor, int)
+    return executor
+
+
+def shutdown_preprocess(wait: bool = True):
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
+
+
+def face_center(image: Image.Image) -> tuple:
+    """
+    작은 썸네일에서 피부색(YCbCr 범위) 픽셀의 무게중심을 0~1 좌표로 찾는다.
+    얼굴 검출기 없이 쓰는 근사치라서 피부색 픽셀이 너무 적으면 None 을 반환한다.
+    """
+    thumb = image.convert('YCbCr')
+    thumb.thumbnail((64, 64))
+    width, height = thumb.size
+    xs = ys = count = 0
+    for index, (_, cb, cr) in enumerate(thumb.getdata()):
+        if 77 <= cb <= 127 and 133 <= cr <= 173:
+            xs += index % width
+            ys += index // width
+            count += 1
+    if count < width * height * 0.02:
+        return None
+    return (xs / count + 0.5) / width, (ys / count + 0.5) / height
+
+
+def crop_box(size: tuple, target: tuple, center) -> tuple:
+    """target 비율로 자를 영역. center 가 없으면 가운데에서 조금 위쪽(인물 사진의 얼굴 위치)을 쓴다."""
+    width, height = size
+    target_width, target_height = target
+    if width * target_height > height * target_width:
+        crop_width, crop_height = round(height * target_width / target_height), height
+    else:
+        crop_width, crop_height = width, round(width * target_height / target_width)
+    cx, cy = center or (0.5, 0.4)
+    left = min(max(round(cx * width - crop_width / 2), 0), width - crop_width)
+    top = min(max(round(cy * height - crop_height / 2), 0), height - crop_height)
+    return left, top, left + crop_width, top + crop_height
+
+
+def preprocess_image(source, target: tuple, output_format: str = INPUT_FORMAT,
+                     max_pixels: int = INPUT_MAX_PIXELS, quality: int = INPUT_JPEG_QUALITY) -> bytes:
+    """
+    (프로세스 풀에서 실행) bytes 또는 파일 경로의 이미지를 EXIF 방향대로 돌리고,
+    얼굴 쪽으로 치우친 target 비율 영역을 잘라 target 크기로 줄인 뒤 인코딩한다.
+    """
+    # Pillow 는 MAX_IMAGE_PIXELS 의 두 배를 넘어야 오류를 내므로 (그 아래는 경고만) 크기를 직접 확인한다
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    image = Image.open(BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source)
+    if image.width * image.height > max_pixels:
+        raise Image.DecompressionBombError(f"Image size ({image.width * image.height} pixels) exceeds limit of {max_pixels} pixels")
+    # JPEG 는 필요한 크기에 가까운 축소 배율로 디코딩해서 큰 사진의 디코딩 시간을 줄인다
+    image.draft('RGB', target)
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    box = crop_box(image.size, target, face_center(image))
+    image = image.resize(target, Image.LANCZOS, box=box, reducing_gap=3.0)
+
+    buffer = BytesIO()
+    if output_format == 'jpeg':
+        image.save(buffer, format='JPEG', quality=quality, subsampling=0)
+    elif output_format == 'webp':
+        image.save(buffer, format='WEBP', quality=quality, method=0)
+    else:
+        image.save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+
+async def prepare_input_image(source, target: tuple = (512, 512)) -> InputImage:
+    """
+    업로드된 얼굴 이미지(UploadFile / bytes / 파일 경로 / PIL Image)를 워크플로 해상도에 맞춰
+    한 번만 전처리해서 InputImage 로 만든다. 이미 InputImage 면 그대로 반환한다.
+    """
+    if isinstance(source, InputImage):
+        return source
+    if isinstance(source, UploadFile):
+        source = await source.read()
+    if isinstance(source, Image.Image):
+        # 예전 호출자 호환용. 이미 디코딩된 이미지는 그대로 PNG 로 넘긴다.
+        buffer = BytesIO()
+        await asyncio.get_running_loop().run_in_executor(None, lambda: source.save(buffer, format='PNG'))
+        source = buffer.getvalue()
+
+    content_type, extension = FORMATS.get(INPUT_FORMAT, FORMATS['jpeg'])
+    cache_key = None
+    if isinstance(source, str):
+        try:
+            stat = os.stat(source)
+        except OSError:
+            raise HTTPException(status_code=404, detail=f"Image not found: {source}")
+        cache_key = (source, stat.st_mtime, target)
+        cached = _path_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    elif len(source) > INPUT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image is too large (max {INPUT_MAX_BYTES} bytes)")
+
+    try:
+        with span('decode'):
+            data = await run_in_pool(preprocess_image, source, target, INPUT_FORMAT)
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail=f"Image has too many pixels (max {INPUT_MAX_PIXELS})")
+    except (UnidentifiedImageError, OSError, SyntaxError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image: {str(e)}")
+
+    image = InputImage(data, content_type, extension)
+    if cache_key is not None:
+        _path_cache[cache_key] = image
+    return image
@@ -0,0 +1,76 @@
+import logging
+import os
+from io import BytesIO
+
+from PIL import Image, features
+
+from image_preprocess import run_in_pool
+
+logger = logging.getLogger(__name__)
+
+# 이름:긴 변 픽셀 목록. 0 은 원본 크기를 그대로 둔다.
+OUTPUT_VARIANTS = os.getenv("OUTPUT_VARIANTS", "thumb:128,feed:256,full:0")
+# 쉼표로 구분한 형식 목록. 설치된 Pillow 가 지원하지 않는 형식(avif 등)은 건너뛴다.
+OUTPUT_VARIANT_FORMATS = os.getenv("OUTPUT_VARIANT_FORMATS", "webp")
+OUTPUT_VARIANT_QUALITY = int(os.getenv("OUTPUT_VARIANT_QUALITY", "80"))
+
+CONTENT_TYPES = {
+    'webp': "image/webp",
+    'avif': "image/avif",
+}
+
+
+def parse_variants(spec: str) -> dict:
+    variants = {}
+    for item in spec.split(','):
+        name, _, size = item.strip().partition(':')
+        if name:
+            variants[name] = int(size or 0)
+    return variants
+
+
+def supported_formats(spec: str) -> list:
+    formats = []
+    for fmt in (item.strip().lower() for item in spec.split(',')):
+        if fmt not in CONTENT_TYPES:
+            continue
+        if not features.check(fmt):
+            logger.warning("Output variant format not supported by Pillow, skipping: %s", fmt)
+            continue
+        formats.append(fmt)
+    return formats
+
+
+VARIANT_SIZES = parse_variants(OUTPUT_VARIANTS)
+VARIANT_FORMATS = supported_formats(OUTPUT_VARIANT_FORMATS)
+
+
+def build_variants(data: bytes, sizes: dict, formats: list, quality: int = OUTPUT_VARIANT_QUALITY) -> dict:
+    """(프로세스 풀에서 실행) 결과 PNG 하나로 {이름: {형식: 인코딩된 bytes}} 를 만든다."""
+    source = Image.open(BytesIO(data))
+    source.load()
+    if source.mode not in ('RGB', 'RGBA'):
+        source = source.convert('RGB')
+
+    variants = {}
+    for name, size in sizes.items():
+        image = source
+        if size and max(source.size) > size:
+            image = source.copy()
+            image.thumbnail((size, size), Image.LANCZOS)
+        encoded = {}
+        for fmt in formats:
+            buffer = BytesIO()
+            if fmt == 'webp':
+                image.save(buffer, format='WEBP', quality=quality, method=4)
+            else:
+                image.save(buffer, format='AVIF', quality=quality, speed=8)
+            encoded[fmt] = buffer.getvalue()
+        variants[name] = encoded
+    return variants
+
+
+async def make_variants(data: bytes) -> dict:
+    if not VARIANT_SIZES or not VARIANT_FORMATS:
+        return {}
+    return await run_in_pool(build_variants, data, VARIANT_SIZES, VARIANT_FORMATS)
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# 대기 중인 작업이 이보다 많으면 새 작업을 받지 않고 503을 돌려준다
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "100"))
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETE = "complete"
+FAILED = "failed"
+
+
+class Job:
+    def __init__(self, row: sqlite3.Row):
+        self.id = row['id']
+        self.kind = row['kind']
+        self.uid = row['uid']
+        self.status = row['status']
+        self.payload = json.loads(row['payload'] or '{}')
+        self.image = row['image']
+        self.results = json.loads(row['results'] or '{}')
+        self.error = row['error']
+        self.created_at = row['created_at']
+        self.updated_at = row['updated_at']
+
+    def to_dict(self) -> dict:
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'uid': self.uid,
+            'status': self.status,
+            'results': self.results,
+            'error': self.error,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+        }
+
+
+class JobStore:
+    """
+    작업 상태를 로컬 SQLite 파일에 저장한다. 프로세스가 재시작되어도 작업과 감정별 부분 결과가 남는다.
+
+    sqlite3 호출은 블로킹이므로 스레드 하나짜리 실행기에서 순서대로 실행한다.
+    """
+
+    def __init__(self, path: str = JOBS_DB_PATH):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+        self._conn = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                uid TEXT,
+                status TEXT NOT NULL,
+                payload TEXT,
+                image BLOB,
+                results TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        conn.commit()
+        return conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def open(self):
+        self._conn = await self._run(self._connect)
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    async def create(self, kind: str, uid: str, payload: dict, image: bytes = None) -> Job:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+
+        def insert():
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, uid, status, payload, image, results, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, '{}', ?, ?)",
+                (job_id, kind, uid, QUEUED, json.dumps(payload), image, now, now),
+            )
+            self._conn.commit()
+
+        await self._run(insert)
+        return await self.get(job_id)
+
+    async def get(self, job_id: str) -> Job:
+        def select():
+            return self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+        row = await self._run(select)
+        return Job(row) if row is not None else None
+
+    async def unfinished(self) -> list:
+        def select():
+            return self._conn.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING)
+            ).fetchall()
+
+        return [row['id'] for row in await self._run(select)]
+
+    async def set_status(self, job_id: str, status: str, error: str = None):
+        def update():
+            if status in (COMPLETE, FAILED):
+                # 끝난 작업의 입력 이미지는 더 필요 없으므로 지워서 DB 크기를 줄인다
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, image = NULL, updated_at = ? WHERE id = ?",
+                    (status, error, time.time(), job_id),
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                    (status, error, time.time(), job_id),
+                )
+            self._conn.commit()
+
+        await self._run(update)
+
+    async def set_result(self, job_id: str, emotion: str, result: dict):
+        def update():
+            self._conn.execute(
+                "UPDATE jobs SET results = json_set(results, ?, json(?)), updated_at = ? WHERE id = ?",
+                (f'$."{emotion}"', json.dumps(result), time.time(), job_id),
+            )
+            self._conn.commit()
+
+        await self._run(update)
+
+
+class JobManager:
+    """
+    정해진 수의 워커가 저장된 작업을 하나씩 꺼내 handler(job, on_result)로 실행한다.
+
+    handler 는 감정 하나가 끝날 때마다 on_result(emotion, result)를 불러 부분 결과를 저장할 수 있다.
+    시작할 때 끝나지 않은 작업(queued / running)을 다시 큐에 넣으므로 재시작해도 작업이 사라지지 않는다.
+    """
+
+    def __init__(self, store: JobStore, handler, workers: int = JOB_WORKERS, queue_limit: int = JOB_QUEUE_LIMIT):
+        self.store = store
+        self.handler = handler
+        self.worker_count = workers
+        self.queue_limit = queue_limit
+        self._queue = asyncio.Queue()
+        self._workers = []
+        self.running = 0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    async def start(self):
+        await self.store.open()
+        recovered = await self.store.unfinished()
+        for job_id in recovered:
+            self._queue.put_nowait(job_id)
+        if recovered:
+            logger.info("미완료 작업 %d개를 다시 큐에 넣었습니다", len(recovered))
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.worker_count)]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        await self.store.close()
+
+    async def submit(self, kind: str, uid: str, payload: dict, image: bytes = None) -> Job:
+        if self.depth >= self.queue_limit:
+            raise HTTPException(status_code=503, detail="Job queue is full", headers={"Retry-After": "30"})
+        job = await self.store.create(kind, uid, payload, image)
+        self._queue.put_nowait(job.id)
+        return job
+
+    async def get(self, job_id: str) -> Job:
+        return await self.store.get(job_id)
+
+    def metrics(self) -> dict:
+        return {
+            'queued': self.depth,
+            'running': self.running,
+            'workers': self.worker_count,
+            'queue_limit': self.queue_limit,
+        }
+
+    async def _worker(self, index: int):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str):
+        job = await self.store.get(job_id)
+        if job is None or job.status in (COMPLETE, FAILED):
+            return
+
+        async def on_result(emotion: str, result: dict):
+            await self.store.set_result(job_id, emotion, result)
+
+        self.running += 1
+        await self.store.set_status(job_id, RUNNING)
+        try:
+            await self.handler(job, on_result)
+        except asyncio.CancelledError:
+            # 종료 중에 취소된 작업은 running 으로 남겨두고 다음 시작 때 다시 실행한다
+            raise
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            logger.warning("Job %s failed: %s", job_id, detail)
+            await self.store.set_status(job_id, FAILED, str(detail))
+        else:
+            await self.store.set_status(job_id, COMPLETE)
+        finally:
+            self.running -= 1
@@ -0,0 +1,219 @@
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Prometheus 텍스트 형식(/metrics)으로 내보내는 간단한 카운터 / 게이지 / 히스토그램.
+# 값은 이벤트 루프와 Firebase 스레드 풀 양쪽에서 바뀌므로 lock 으로 보호한다.
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+# INFO 이하 로그 중 이 비율만 남긴다 (WARNING 이상은 항상 남긴다)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value) -> list:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def _render_value(self, key, value) -> list:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _labels(self.labelnames + ('le',), key + (_number(bound),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_number(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """collector() 는 스크랩할 때마다 불려서 Metric 목록을 반환한다 (풀 / 캐시 상태 같은 현재 값용)."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                for metric in collector():
+                    lines.extend(metric.render())
+            except Exception as e:
+                logging.getLogger(__name__).warning("metrics collector failed: %s", e)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    'mirror_stage_seconds', "Time spent in each generation stage",
+    ('stage', 'workflow', 'emotion', 'backend'),
+))
+STAGE_ERRORS = registry.register(Counter(
+    'mirror_stage_errors_total', "Generation stages that raised an exception",
+    ('stage', 'workflow', 'emotion', 'backend'),
+))
+STAGE_INFLIGHT = registry.register(Gauge(
+    'mirror_stage_inflight', "Generation stages currently running", ('stage',),
+))
+EMOTION_RESULTS = registry.register(Counter(
+    'mirror_emotion_results_total', "Emotion images finished, by result status", ('status',),
+))
+PROMPTS_CANCELLED = registry.register(Counter(
+    'mirror_prompts_cancelled_total', "ComfyUI prompts removed from the queue or interrupted",
+    ('reason', 'action'),
+))
+
+
+# 지금 처리 중인 감정 / 워크플로. 깊은 호출(업로드, ComfyUI 대기)의 span 에도 같은 라벨이 붙는다.
+# asyncio 태스크는 만들어질 때의 값을 이어받는다.
+_tags = ContextVar('metric_tags', default={})
+
+
+@contextmanager
+def tagged(**tags):
+    """with tagged(emotion='joy', workflow='persona'): 블록 안의 span 에 라벨을 붙인다."""
+    token = _tags.set({**_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def _stage_labels(stage: str, labels: dict) -> dict:
+    merged = {**_tags.get(), **labels}
+    return {
+        'stage': stage,
+        'workflow': merged.get('workflow', ''),
+        'emotion': merged.get('emotion', ''),
+        'backend': merged.get('backend', ''),
+    }
+
+
+@contextmanager
+def span(stage: str, **labels):
+    """with span('output_fetch', backend=url): ... 구간의 시간을 stage 별 히스토그램에 기록한다."""
+    labels = _stage_labels(stage, labels)
+    STAGE_INFLIGHT.inc(stage=stage)
+    started = time.perf_counter()
+    try:
+        yield labels
+    except BaseException:
+        STAGE_ERRORS.inc(**labels)
+        raise
+    finally:
+        STAGE_INFLIGHT.dec(stage=stage)
+        STAGE_SECONDS.observe(time.perf_counter() - started, **labels)
+
+
+def observe_stage(stage: str, seconds: float, **labels):
+    """with 블록으로 감쌀 수 없는 구간(웹소켓 이벤트 사이의 시간 등)을 직접 기록한다."""
+    STAGE_SECONDS.observe(seconds, **_stage_labels(stage, labels))
+
+
+class SampleFilter(logging.Filter):
+    """WARNING 미만 로그는 rate 비율만 통과시킨다. 부하가 걸렸을 때 진행 로그가 쏟아지지 않게 한다."""
+
+    def __init__(self, rate: float = LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or self.rate >= 1.0 or random.random() < self.rate
@@ -0,0 +1,216 @@
+import asyncio
+import copy
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from firebase_admin import firestore
+
+import singleflight
+from firebase_io import get_document, run_firebase
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+# users/{uid} 문서를 다시 읽지 않고 쓰는 시간(초). 한 요청 안의 중복 읽기와 연달아 온 요청을 합친다.
+PERSONA_CACHE_TTL = float(os.getenv("PERSONA_CACHE_TTL", "5"))
+PERSONA_CACHE_SIZE = int(os.getenv("PERSONA_CACHE_SIZE", "1024"))
+# 이 시간(초) 동안 들어온 쓰기를 트랜잭션 하나로 모은다
+PERSONA_WRITE_WINDOW = float(os.getenv("PERSONA_WRITE_WINDOW", "0.05"))
+# 트랜잭션 하나에 넣을 최대 사용자 수 (Firestore 트랜잭션은 문서 500개까지)
+PERSONA_WRITE_BATCH = int(os.getenv("PERSONA_WRITE_BATCH", "100"))
+
+
+class PendingWrite:
+    """한 사용자 문서에 모인 쓰기. 같은 창 안에서 온 패치는 필드 단위로 합친다."""
+
+    def __init__(self):
+        self.fields = {}  # 최상위 필드 -> 값 (set merge=True 로 쓴다)
+        self.persona = {}  # persona 배열 인덱스 -> {필드: 값}
+        self.futures = []
+
+    def merge(self, fields: dict, persona: dict):
+        self.fields = merge_fields(self.fields, fields)
+        for index, patch in persona.items():
+            self.persona.setdefault(index, {}).update(patch)
+
+
+def merge_fields(current: dict, fields: dict) -> dict:
+    """set(merge=True) 와 같은 규칙으로 합친다. 중첩 map 은 필드 단위로, 나머지 값(배열 포함)은 통째로 바꾼다."""
+    merged = dict(current)
+    for key, value in fields.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = merge_fields(merged[key], value)
+        merged[key] = value
+    return merged
+
+
+def apply_persona_patch(persona: list, patches: dict) -> list:
+    """persona 배열의 인덱스별 항목에 필드를 덮어쓴다. 모자란 항목은 빈 dict 로 채운다."""
+    persona = [dict(item) if isinstance(item, dict) else {} for item in (persona or [])]
+    if patches:
+        while len(persona) <= max(patches):
+            persona.append({})
+    for index, patch in patches.items():
+        persona[index].update(patch)
+    return persona
+
+
+class PersonaStore:
+    """
+    users/{uid} 문서의 읽기 캐시와 쓰기 모음.
+
+    읽기는 짧은 TTL 동안 기억하고 동시에 들어온 같은 사용자 읽기는 하나로 합친다.
+    쓰기는 PERSONA_WRITE_WINDOW 동안 모아서 트랜잭션 하나로 보낸다. persona 배열 패치는 트랜잭션 안에서
+    최신 배열을 읽어 항목의 필드만 바꾸므로 동시에 끝난 요청이 서로의 결과를 덮어쓰지 않는다.
+    """
+
+    def __init__(self, db=None, collection: str = 'users', ttl: float = PERSONA_CACHE_TTL,
+                 max_entries: int = PERSONA_CACHE_SIZE, window: float = PERSONA_WRITE_WINDOW,
+                 batch_size: int = PERSONA_WRITE_BATCH):
+        self._db = db
+        self.collection = collection
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.window = window
+        self.batch_size = batch_size
+        self._entries = OrderedDict()  # uid -> (문서 dict 또는 None, 읽은 시각)
+        self._inflight = {}  # uid -> 진행 중인 읽기 Task
+        self._pending = {}  # uid -> PendingWrite
+        self._flush_task = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.transactions = 0
+
+    @property
+    def db(self):
+        # firebase_admin.initialize_app 이 끝난 뒤에 처음 쓸 때 클라이언트를 얻는다
+        if self._db is None:
+            self._db = firestore.client()
+        return self._db
+
+    def document(self, uid: str):
+        return self.db.collection(self.collection).document(uid)
+
+    async def get_user(self, uid: str):
+        """users/{uid} 문서 dict (없으면 None). 호출자가 고쳐도 캐시에 영향이 없도록 사본을 준다."""
+        entry = self._entries.get(uid)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self._entries.move_to_end(uid)
+            self.hits += 1
+            return copy.deepcopy(entry[0])
+
+        if uid in self._inflight:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return copy.deepcopy(await singleflight.run(self._inflight, uid, lambda: self._read(uid)))
+
+    async def _read(self, uid: str):
+        doc = await get_document(self.document(uid))
+        self._entries[uid] = (doc, time.monotonic())
+        self._entries.move_to_end(uid)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return doc
+
+    def invalidate(self, uid: str):
+        self._entries.pop(uid, None)
+
+    async def update_fields(self, uid: str, fields: dict):
+        """최상위 필드를 (중첩 map 은 필드 단위로 합쳐서) 쓴다. 모아 둔 트랜잭션이 끝나면 돌아온다."""
+        await self._enqueue(uid, fields, {})
+
+    async def patch_persona(self, uid: str, patches: dict, fields: dict = None):
+        """
+        persona 배열의 {인덱스: {필드: 값}} 패치를 쓴다. 배열 전체를 덮어쓰지 않고
+        트랜잭션 안에서 읽은 최신 배열의 해당 항목 필드만 바꾼다.
+        """
+        await self._enqueue(uid, fields or {}, patches)
+
+    async def _enqueue(self, uid: str, fields: dict, persona: dict):
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.get(uid)
+        if pending is None:
+            pending = self._pending[uid] = PendingWrite()
+        pending.merge(fields, persona)
+        pending.futures.append(future)
+        self.writes += 1
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_after(self.window))
+        # 기다리던 요청이 취소되어도 모아 둔 쓰기는 그대로 보낸다
+        await asyncio.shield(future)
+
+    async def _flush_after(self, delay: float):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        uids = list(pending)
+        for start in range(0, len(uids), self.batch_size):
+            batch = {uid: pending[uid] for uid in uids[start:start + self.batch_size]}
+            try:
+                with span('firestore_write'):
+                    await run_firebase(self._commit, batch)
+                self.transactions += 1
+                error = None
+            except Exception as e:
+                logger.warning("Persona write failed for %d users: %s", len(batch), e)
+                error = e
+            for uid, write in batch.items():
+                self.invalidate(uid)
+                for future in write.futures:
+                    if future.done():
+                        continue
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+
+    def _commit(self, batch: dict):
+        """(Firebase 스레드 풀에서 실행) 모은 쓰기를 트랜잭션 하나로 보낸다. 충돌하면 라이브러리가 다시 시도한다."""
+        refs = {uid: self.document(uid) for uid in batch}
+
+        @firestore.transactional
+        def apply(transaction):
+            # 트랜잭션은 모든 읽기가 쓰기보다 먼저 와야 한다
+            patched = [refs[uid] for uid, write in batch.items() if write.persona]
+            docs = {}
+            if patched:
+                for snapshot in self.db.get_all(patched, transaction=transaction):
+                    docs[snapshot.id] = snapshot.to_dict() if snapshot.exists else None
+            for uid, write in batch.items():
+                data = dict(write.fields)
+                if write.persona:
+                    current = (docs.get(uid) or {}).get('persona')
+                    data['persona'] = apply_persona_patch(current if isinstance(current, list) else [], write.persona)
+                transaction.set(refs[uid], data, merge=True)
+
+        apply(self.db.transaction())
+
+    async def close(self):
+        """모아 둔 쓰기를 지금 보낸다 (종료할 때)."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._pending:
+            await self.flush()
+
+    def metrics(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'pending_writes': len(self._pending),
+            'writes': self.writes,
+            'transactions': self.transactions,
+        }
+
+
+persona_store = PersonaStore()
@@ -0,0 +1,249 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import singleflight
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", str(24 * 3600)))
+# 설정하면 메모리에서 밀려난 결과도 이 폴더의 JSON 파일로 남아 재시작 후에도 다시 쓸 수 있다
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR")
+# 0 이면 결과 캐시를 쓰지 않는다 (동시 요청 합치기는 계속 한다)
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") != "0"
+
+
+def result_key(image, template, params: dict, seed_policy: str = "random") -> str:
+    """
+    (입력 이미지 해시, 워크플로 템플릿, 프롬프트 파라미터, 시드 정책) -> 캐시 키.
+
+    seed_policy 가 "random" 이면 시드는 매번 새로 뽑으므로 키에서 빼고,
+    그 밖의 정책("fixed" 등)은 시드 값까지 키에 넣는다.
+    """
+    keyed = {name: value for name, value in params.items() if name != 'image'}
+    if seed_policy == "random":
+        keyed.pop('seed', None)
+    material = json.dumps({
+        'image': image.digest,
+        'template': template.name,
+        'workflow': template.digest,
+        'params': keyed,
+        'seed_policy': seed_policy,
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    캐시 키 -> 완료된 감정 이미지 결과({'status': 'complete', 'image_url': ...}).
+
+    같은 사진과 같은 프롬프트로 다시 요청하면 ComfyUI를 다시 돌리지 않고 저장된 결과를 돌려주고,
+    동시에 들어온 같은 요청은 진행 중인 생성 하나를 함께 기다린다.
+    실패한 결과는 저장하지 않는다.
+    """
+
+    def __init__(self, max_entries: int = RESULT_CACHE_SIZE, ttl: float = RESULT_CACHE_TTL,
+                 cache_dir: str = RESULT_CACHE_DIR, enabled: bool = RESULT_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self._entries = OrderedDict()  # key -> (result, created_at)
+        self._inflight = {}  # key -> 진행 중인 생성 Task
+        self._waiters = {}  # key -> 그 생성을 기다리는 요청 수
+        self.hits = 0
+        self.disk_hits = 0
+        self.joined = 0
+        self.misses = 0
+
+    async def get_or_generate(self, key: str, generate, on_hit=None) -> dict:
+        """
+        key 에 해당하는 결과를 돌려준다. 없으면 generate() 코루틴으로 만든다.
+        on_hit 이 주어지면 저장된 결과를 쓸 때 (생성 없이 끝날 때) 불린다.
+        """
+        result = await self._lookup(key)
+        if result is not None:
+            if on_hit is not None:
+                on_hit()
+            return result
+
+        # 먼저 온 요청이 취소되어도 같은 생성을 기다리는 요청이 남아 있으면 계속되도록 별도 태스크로 실행한다
+        if key in self._inflight:
+            self.joined += 1
+        else:
+            self.misses += 1
+        return await self._wait(key, singleflight.task(self._inflight, key, lambda: self._generate_and_store(key, generate)))
+
+    async def get_or_generate_many(self, keys: dict, generate_many, on_hit=None) -> dict:
+        """
+        {이름: key} 를 한꺼번에 찾는다. 저장된 결과도 진행 중인 생성도 없는 것만 모아
+        generate_many(names) 코루틴 한 번으로 만든다. generate_many 는 {이름: 결과}를 반환해야 한다.
+        on_hit(name)은 저장된 결과를 쓴 이름마다 불린다.
+        """
+        results = {}
+        waiting = {}
+        missing = []
+        for name, key in keys.items():
+            result = await self._lookup(key)
+            if result is not None:
+                if on_hit is not None:
+                    on_hit(name)
+                results[name] = result
+        # 조회 중에 다른 요청이 같은 키를 맡았을 수 있으므로 맡을 키는 await 없이 한 번에 정한다
+        for name, key in keys.items():
+            if name in results:
+                continue
+            if key in self._inflight:
+                self.joined += 1
+                waiting[name] = self._inflight[key]
+            else:
+                missing.append(name)
+
+        if missing:
+            self.misses += len(missing)
+            batch = asyncio.create_task(generate_many(missing))
+            stores = []
+
+            def release(_):
+                # 배치의 키가 모두 취소되었으면(기다리는 요청이 없으면) 배치도 멈춘다
+                if all(store.done() for store in stores) and not batch.done():
+                    batch.cancel()
+
+            for name in missing:
+                key = keys[name]
+                task = asyncio.create_task(self._store_from_batch(key, batch, name))
+                singleflight.track(self._inflight, key, task)
+                task.add_done_callback(release)
+                stores.append(task)
+                waiting[name] = task
+
+        values = await asyncio.gather(*(self._wait(keys[name], task) for name, task in waiting.items()), return_exceptions=True)
+        for name, value in zip(waiting, values):
+            if isinstance(value, asyncio.CancelledError):
+                raise value
+            if isinstance(value, Exception):
+                value = {'status': 'error', 'message': str(value)}
+            results[name] = value
+        return {name: results[name] for name in keys}
+
+    async def _store_from_batch(self, key: str, batch: asyncio.Task, name: str) -> dict:
+        return await self._generate_and_store(key, lambda: self._batch_result(batch, name))
+
+    @staticmethod
+    async def _batch_result(batch: asyncio.Task, name: str) -> dict:
+        # 키 하나가 취소되어도 같은 배치의 다른 키는 계속 기다릴 수 있게 한다
+        return (await asyncio.shield(batch))[name]
+
+    async def _wait(self, key: str, task: asyncio.Task) -> dict:
+        """
+        진행 중인 생성을 기다린다. 기다리던 요청이 모두 취소되면 생성 태스크도 취소해서
+        ComfyUI 작업과 Storage 업로드를 멈춘다.
+        """
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    async def _lookup(self, key: str):
+        if not self.enabled:
+            return None
+        self._evict_expired()
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if self.cache_dir:
+            entry = await asyncio.get_running_loop().run_in_executor(None, self._read_disk, key)
+            if entry is not None:
+                self._store_memory(key, *entry)
+                self.disk_hits += 1
+                return entry[0]
+        return None
+
+    async def _generate_and_store(self, key: str, generate) -> dict:
+        result = await generate()
+        if self.enabled and result.get('status') == 'complete':
+            created_at = time.time()
+            self._store_memory(key, result, created_at)
+            if self.cache_dir:
+                await asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, result, created_at)
+        return result
+
+    def invalidate(self, key: str):
+        self._entries.pop(key, None)
+        if self.cache_dir:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def _store_memory(self, key: str, result: dict, created_at: float):
+        self._entries[key] = (result, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _evict_expired(self):
+        cutoff = time.time() - self.ttl
+        expired = [key for key, (_, created_at) in self._entries.items() if created_at < cutoff]
+        for key in expired:
+            del self._entries[key]
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key: str):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Failed to read result cache file %s: %s", path, e)
+            return None
+        if entry['created_at'] < time.time() - self.ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry['result'], entry['created_at']
+
+    def _write_disk(self, key: str, result: dict, created_at: float):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 쓰는 도중에 읽히지 않도록 임시 파일에 쓰고 교체한다
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump({'result': result, 'created_at': created_at}, file, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Failed to write result cache file %s: %s", path, e)
+
+    def metrics(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'inflight': len(self._inflight),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'joined': self.joined,
+            'misses': self.misses,
+        }
+
+
+result_cache = ResultCache()
@@ -0,0 +1,34 @@
+import asyncio
+
+
+def task(inflight: dict, key, coro_factory) -> asyncio.Task:
+    """
+    key 의 작업이 진행 중이면 그 Task 를, 없으면 coro_factory() 를 새 Task 로 시작해서 돌려준다.
+
+    inflight 는 호출자가 가진 {key: Task} dict 로, Task 가 끝나면 거기서 빠진다.
+    먼저 온 요청이 취소되어도 같은 작업을 기다리는 요청이 있을 수 있으므로 작업은 별도 Task 로 실행한다.
+    """
+    running = inflight.get(key)
+    if running is None:
+        running = asyncio.create_task(coro_factory())
+        track(inflight, key, running)
+    return running
+
+
+def track(inflight: dict, key, running: asyncio.Task):
+    """이미 만든 Task 를 key 의 진행 중인 작업으로 등록한다."""
+    inflight[key] = running
+    running.add_done_callback(lambda t: _done(inflight, key, t))
+
+
+async def run(inflight: dict, key, coro_factory):
+    """key 의 작업을 (없으면 시작해서) 기다린다. 기다리던 요청이 취소되어도 작업은 계속된다."""
+    return await asyncio.shield(task(inflight, key, coro_factory))
+
+
+def _done(inflight: dict, key, running: asyncio.Task):
+    if inflight.get(key) is running:
+        del inflight[key]
+    if not running.cancelled():
+        # 기다리는 쪽이 모두 취소된 경우에도 "exception was never retrieved" 경고가 나지 않게 한다
+        running.exception()
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import os
+import time
+
+from comfyui_pool import COMFYUI_HEALTH_INTERVAL
+from generate_image import character_params, run_on_backend
+from image_preprocess import prepare_input_image
+from image_prompt import prompt
+from metrics import observe_stage
+from workflow_templates import workflow_registry
+
+logger = logging.getLogger(__name__)
+
+# 0이면 워밍업 없이 바로 준비된 것으로 본다 (로컬 개발 등)
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+# 워밍업 prompt 의 샘플링 step 수. 모델을 VRAM 에 올리는 것이 목적이라 결과 품질은 상관없다.
+WARMUP_STEPS = int(os.getenv("WARMUP_STEPS", "2"))
+# 워밍업에 쓰는 입력 얼굴 (기본 아바타라서 전처리 / 업로드 캐시도 함께 데워진다)
+WARMUP_IMAGE = os.getenv("WARMUP_IMAGE", "assets/images/female.webp")
+# 워밍업이 실패한 서버를 다시 시도하기까지의 시간(초)
+WARMUP_RETRY_INTERVAL = float(os.getenv("WARMUP_RETRY_INTERVAL", "30"))
+
+
+class BackendWarmup:
+    """ComfyUI 서버 하나의 워밍업 상태: cold -> warming -> ready (실패하면 failed)"""
+
+    def __init__(self):
+        self.state = 'cold'
+        self.timings = {}  # 워크플로 이름 -> 구간별 시간(초)
+        self.warmed_at = None
+        self.error = None
+        self.failed_at = None
+
+    def to_dict(self) -> dict:
+        return {
+            'state': self.state,
+            'timings': self.timings,
+            'warmed_at': self.warmed_at,
+            'error': self.error,
+        }
+
+
+class ComfyUIWarmup:
+    """
+    등록된 워크플로마다 적은 step 의 prompt 를 모든 ComfyUI 서버에 한 번씩 실행해서
+    체크포인트 / LoRA / IPAdapter / InsightFace / ControlNet 을 사용자 요청 전에 올려 둔다.
+
+    상태 확인 주기마다 서버를 살펴서, 죽었다 살아난 서버(ComfyUI 재시작으로 모델이 내려감)는 다시 데운다.
+    ready 는 데운 서버가 하나 이상 있고 정상인 서버가 모두 데워졌을 때만 참이다.
+    """
+
+    def __init__(self, pool, registry=workflow_registry, enabled: bool = WARMUP_ENABLED,
+                 steps: int = WARMUP_STEPS, image: str = WARMUP_IMAGE,
+                 interval: float = COMFYUI_HEALTH_INTERVAL, retry_interval: float = WARMUP_RETRY_INTERVAL):
+        self.pool = pool
+        self.registry = registry
+        self.enabled = enabled
+        self.steps = steps
+        self.image = image
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self._status = {backend.base_url: BackendWarmup() for backend in pool.backends}
+        self._task = None
+
+    async def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                logger.warning("ComfyUI warm-up check failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def check(self):
+        """데워야 할 서버(처음 보거나 다시 살아난 서버, 재시도 시간이 지난 실패 서버)를 동시에 데운다."""
+        now = time.monotonic()
+        warming = []
+        for backend in self.pool.backends:
+            status = self._status[backend.base_url]
+            if not backend.healthy:
+                # ComfyUI 가 재시작되면 올려 둔 모델이 사라지므로 살아나면 다시 데운다
+                if status.state == 'ready':
+                    status.state = 'cold'
+                continue
+            if status.state in ('ready', 'warming'):
+                continue
+            if status.state == 'failed' and now - status.failed_at < self.retry_interval:
+                continue
+            warming.append(self.warm(backend))
+        if warming:
+            await asyncio.gather(*warming)
+
+    async def warm(self, backend):
+        status = self._status[backend.base_url]
+        status.state = 'warming'
+        started = time.monotonic()
+        try:
+            # 같은 서버에서는 차례로 실행한다 (공유하는 모델을 두 prompt 가 함께 올리며 VRAM 을 다투지 않게)
+            for name in self.registry.names():
+                status.timings[name] = await self._render(backend, self.registry.get(name))
+        except Exception as e:
+            status.state = 'failed'
+            status.error = repr(e)
+            status.failed_at = time.monotonic()
+            logger.warning("ComfyUI warm-up failed on %s: %r", backend.base_url, e)
+            return
+        status.state = 'ready'
+        status.error = None
+        status.warmed_at = time.time()
+        logger.info("ComfyUI backend warmed up in %.1fs: %s %s",
+                    time.monotonic() - started, backend.base_url, status.timings)
+
+    async def _render(self, backend, template) -> dict:
+        started = time.monotonic()
+        image = await prepare_input_image(self.image, template.input_size)
+        params = {
+            **character_params(prompt['joy']),
+            'steps': self.steps,
+            'split_step': max(1, self.steps // 2),
+        }
+        # 템플릿에 없는 슬롯(예: step 을 바꿀 수 없는 워크플로)은 기본값 그대로 둔다
+        params = {name: value for name, value in params.items() if name in template.slots}
+        queued_at = running_at = None
+
+        def track(event):
+            nonlocal queued_at, running_at
+            now = time.monotonic()
+            if queued_at is None and event.get('state') == 'queued':
+                queued_at = now
+            if running_at is None and event.get('state') == 'running':
+                running_at = now
+
+        # 결과 이미지는 쓰지 않으므로 Storage 에 올리지 않고 prompt 가 끝나기만 기다린다.
+        # 워밍업의 모델 로드 시간이 서버의 평균 지연 시간에 섞이지 않게 record=False 로 실행한다.
+        result = await run_on_backend(backend, lambda image_ref: template.render(image=image_ref, **params), image,
+                                      output_node=None, on_event=track, record=False)
+        finished = time.monotonic()
+        if result is None:
+            raise TimeoutError(f"Warm-up prompt for {template.name} timed out on {backend.base_url}")
+
+        queued_at = queued_at or started
+        running_at = running_at or queued_at
+        observe_stage('warmup', finished - started, workflow=template.name, backend=backend.base_url)
+        return {
+            'upload': round(queued_at - started, 3),
+            'queue_wait': round(running_at - queued_at, 3),
+            # 모델 로드가 대부분인 실행 시간
+            'run': round(finished - running_at, 3),
+            'total': round(finished - started, 3),
+        }
+
+    @property
+    def ready(self) -> bool:
+        if not self.enabled:
+            return True
+        warmed = False
+        for backend in self.pool.backends:
+            state = self._status[backend.base_url].state
+            if state == 'ready':
+                warmed = True
+            elif backend.available:
+                return False
+        return warmed
+
+    def metrics(self) -> dict:
+        return {base_url: status.to_dict() for base_url, status in self._status.items()}
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+# 파일이 바뀌었는지 확인하는 최소 간격(초). 0이면 매번 확인한다.
+WORKFLOW_RELOAD_INTERVAL = float(os.getenv("WORKFLOW_RELOAD_INTERVAL", "2"))
+
+NEGATIVE_PROMPT = "cross-eyed, unnatural eye alignment, distorted gaze direction, mismatched eye position, asymmetrical eyes, exaggerated reflections in eyes, blurred lips, smudged lips, distorted mouth, missing teeth, uneven teeth, broken teeth, overly sharp or exaggerated teeth, unnatural skin texture, unrealistic facial symmetry, artifacts, low quality, deformed face features, blurry details"
+
+# workflow.json 계열 그래프에서 요청마다 바뀌는 입력 (파라미터 이름 -> [(노드 id, 입력 이름)])
+PERSONA_SLOTS = {
+    'image': [("1", "image")],
+    'positive': [("25", "text"), ("34", "text")],
+    'negative': [("7", "text"), ("24", "text")],
+    'seed': [("19", "noise_seed"), ("28", "noise_seed")],
+    'batch_size': [("15", "batch_size")],
+    # 두 KSamplerAdvanced 가 나눠 쓰는 전체 step 수와 그 경계 (19 는 0~split, 28 은 split~끝)
+    'steps': [("19", "steps"), ("28", "steps")],
+    'split_step': [("19", "end_at_step"), ("28", "start_at_step")],
+}
+
+
+class WorkflowTemplate:
+    """
+    ComfyUI API 형식 워크플로 하나와 그 파라미터 슬롯.
+
+    render()는 그래프 전체를 deepcopy 하지 않고, 슬롯이 가리키는 노드만 새 dict로 만들어
+    값을 덮어쓴다. 나머지 노드는 원본과 공유하므로 render 결과를 직접 고치면 안 된다.
+    """
+
+    def __init__(self, name: str, path: str, slots: dict, output_node: str = "39"):
+        self.name = name
+        self.path = path
+        self.slots = slots
+        self.output_node = output_node
+        self.graph = None
+        self.digest = None  # 파일 내용 해시. 결과 캐시 키에 넣어 워크플로가 바뀌면 캐시가 갈리게 한다
+        self.mtime = None
+        self._checked_at = 0.0
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as file:
+                raw = file.read()
+            graph = json.loads(raw.decode('utf-8'))
+            mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail=f"Workflow not found: {self.path}")
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid workflow format: {self.path}: {str(e)}")
+        self.validate(graph)
+        self.graph = graph
+        self.digest = hashlib.sha256(raw).hexdigest()
+        self.mtime = mtime
+        self._checked_at = time.monotonic()
+
+    def validate(self, graph: dict):
+        errors = []
+        if self.output_node not in graph:
+            errors.append(f"output node {self.output_node} is missing")
+        for param, targets in self.slots.items():
+            for node_id, input_name in targets:
+                node = graph.get(node_id)
+                if node is None:
+                    errors.append(f"slot '{param}' refers to missing node {node_id}")
+                elif input_name not in node.get('inputs', {}):
+                    errors.append(f"slot '{param}' refers to missing input {node_id}.{input_name}")
+        if errors:
+            raise HTTPException(status_code=400, detail=f"Invalid workflow {self.name}: " + "; ".join(errors))
+
+    def reload_if_changed(self, interval: float = WORKFLOW_RELOAD_INTERVAL):
+        now = time.monotonic()
+        if self.graph is not None and now - self._checked_at < interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if self.graph is None or mtime != self.mtime:
+            try:
+                self.load()
+                logger.info("Workflow template loaded: %s (%s)", self.name, self.path)
+            except HTTPException as e:
+                # 수정 중인 파일이 잘못되었으면 이전 그래프를 계속 쓴다
+                if self.graph is None:
+                    raise
+                logger.warning("Workflow reload failed, keeping previous version: %s", e.detail)
+
+    def render(self, **params) -> dict:
+        unknown = set(params) - set(self.slots)
+        if unknown:
+            raise ValueError(f"Unknown parameters for workflow {self.name}: {sorted(unknown)}")
+
+        graph = dict(self.graph)
+        copied = set()
+        for param, value in params.items():
+            for node_id, input_name in self.slots[param]:
+                if node_id not in copied:
+                    node = graph[node_id]
+                    graph[node_id] = {**node, 'inputs': dict(node['inputs'])}
+                    copied.add(node_id)
+                graph[node_id]['inputs'][input_name] = value
+        return graph
+
+    @property
+    def input_size(self) -> tuple:
+        """EmptyLatentImage 가 정하는 생성 해상도 (width, height). 입력 얼굴 이미지를 이 크기로 맞춘다."""
+        for node in self.graph.values():
+            if node.get('class_type') == 'EmptyLatentImage':
+                inputs = node['inputs']
+                if isinstance(inputs.get('width'), int) and isinstance(inputs.get('height'), int):
+                    return inputs['width'], inputs['height']
+        return 512, 512
+
+    def downstream(self, node_ids) -> set:
+        """node_ids 와 그 출력을 (직간접적으로) 입력으로 받는 모든 노드 id"""
+        children = {}
+        for node_id, node in self.graph.items():
+            for value in node.get('inputs', {}).values():
+                if isinstance(value, list) and len(value) == 2 and value[0] in self.graph:
+                    children.setdefault(value[0], set()).add(node_id)
+        found = set()
+        stack = list(node_ids)
+        while stack:
+            node_id = stack.pop()
+            if node_id in found:
+                continue
+            found.add(node_id)
+            stack.extend(children.get(node_id, ()))
+        return found
+
+    def render_branches(self, branches: dict, **shared) -> tuple:
+        """
+        여러 파라미터 조합({이름: params})을 prompt 하나로 합친다.
+
+        조합마다 값이 다른 슬롯의 노드와 그 아래쪽 노드만 "{노드 id}_{이름}" 으로 복제하고,
+        로더 / LoadImage / 태거처럼 값이 같은 앞부분은 한 번만 넣는다.
+        (그래프, {이름: 출력 노드 id})를 반환한다.
+        """
+        names = list(branches)
+        varying = {}
+        for name in names:
+            unknown = set(branches[name]) - set(self.slots)
+            if unknown:
+                raise ValueError(f"Unknown parameters for workflow {self.name}: {sorted(unknown)}")
+        for param in set().union(*(branches[name] for name in names)):
+            values = [branches[name].get(param) for name in names]
+            if len(names) > 1 and any(value != values[0] for value in values):
+                varying[param] = values
+            elif values[0] is not None:
+                shared.setdefault(param, values[0])
+
+        graph = self.render(**shared)
+        if not varying:
+            return graph, {name: self.output_node for name in names}
+
+        branched = self.downstream(node_id for param in varying for node_id, _ in self.slots[param])
+        for name in names:
+            for node_id in branched:
+                node = graph[node_id]
+                inputs = {}
+                for input_name, value in node['inputs'].items():
+                    if isinstance(value, list) and len(value) == 2 and value[0] in branched:
+                        value = [f"{value[0]}_{name}", value[1]]
+                    inputs[input_name] = value
+                graph[f"{node_id}_{name}"] = {**node, 'inputs': inputs}
+            for param in varying:
+                for node_id, input_name in self.slots[param]:
+                    graph[f"{node_id}_{name}"]['inputs'][input_name] = branches[name][param]
+        for node_id in branched:
+            del graph[node_id]
+        return graph, {name: f"{self.output_node}_{name}" for name in names}
+
+
+class WorkflowRegistry:
+    def __init__(self):
+        self._templates = {}
+
+    def register(self, name: str, path: str, slots: dict, output_node: str = "39") -> WorkflowTemplate:
+        template = WorkflowTemplate(name, path, slots, output_node)
+        self._templates[name] = template
+        return template
+
+    def load_all(self):
+        for template in self._templates.values():
+            template.load()
+
+    def names(self):
+        return list(self._templates)
+
+    def get(self, name: str) -> WorkflowTemplate:
+        template = self._templates.get(name)
+        if template is None:
+            raise HTTPException(status_code=404, detail=f"Workflow not found: {name}")
+        template.reload_if_changed()
+        return template
+
+
+workflow_registry = WorkflowRegistry()
+workflow_registry.register('persona', 'workflow.json', PERSONA_SLOTS)
+# workflow3.json 은 같은 그래프에 FaceDetailer(45)가 붙어 있어서 그 시드도 함께 바꾼다
+workflow_registry.register('persona_detailer', 'workflow3.json', {
+    **PERSONA_SLOTS,
+    'seed': PERSONA_SLOTS['seed'] + [("45", "seed")],
+    'steps': PERSONA_SLOTS['steps'] + [("45", "steps")],
+})